@@ -1,10 +1,11 @@
 """pykraken2 server/client."""
 
 import argparse
+from collections import namedtuple
 from enum import Enum
 import importlib
 import logging
-import pickle
+import struct
 
 import msgpack
 import portpicker
@@ -12,6 +13,8 @@ import portpicker
 __version__ = "0.0.1"
 
 ZMQ_MSG_SIZE = 10000
+MIN_MSG_SIZE = 1000
+MAX_MSG_SIZE = 10000000
 
 
 def get_named_logger(name):
@@ -63,6 +66,77 @@ def free_ports(number=1, lowest=1024):
     return port_list
 
 
+class AdaptiveSize:
+    """Tune a size parameter from throughput measured at runtime.
+
+    A simple hill-climber: observations are accumulated over a window
+    and the throughput (units per second) compared with that of the
+    previous window. If throughput did not get worse the size continues
+    to move in the same direction, otherwise the direction is reversed.
+    The size is always kept within ``[minimum, maximum]``.
+    """
+
+    def __init__(
+            self, initial, minimum, maximum, adaptive=True,
+            factor=2.0, window=4, tolerance=0.05):
+        """Init function.
+
+        :param initial: starting size.
+        :param minimum: smallest permissable size.
+        :param maximum: largest permissable size.
+        :param adaptive: if False, size is fixed at `initial`.
+        :param factor: multiplicative step between sizes.
+        :param window: number of observations per throughput measurement.
+        :param tolerance: fractional drop in throughput tolerated before
+            changing direction.
+        """
+        if minimum > maximum:
+            raise ValueError("minimum must not be greater than maximum.")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.factor = factor
+        self.window = window
+        self.tolerance = tolerance
+        self.value = self._clamp(initial)
+        self._direction = 1
+        self._last_rate = None
+        self._amount = 0
+        self._elapsed = 0.0
+        self._count = 0
+
+    def _clamp(self, value):
+        return int(min(max(value, self.minimum), self.maximum))
+
+    def update(self, amount, elapsed):
+        """Record an observation and return the (possibly new) size.
+
+        :param amount: quantity processed, e.g. bytes sent.
+        :param elapsed: time taken to process `amount`, in seconds.
+        """
+        if not self.adaptive:
+            return self.value
+        self._amount += amount
+        self._elapsed += elapsed
+        self._count += 1
+        if self._count < self.window:
+            return self.value
+
+        rate = self._amount / max(self._elapsed, 1e-9)
+        if self._last_rate is not None \
+                and rate < self._last_rate * (1 - self.tolerance):
+            self._direction = -self._direction
+        self._last_rate = rate
+        self._amount, self._elapsed, self._count = 0, 0.0, 0
+
+        new = self._clamp(self.value * self.factor ** self._direction)
+        if new == self.value:
+            # at a bound, probe back the other way next time
+            self._direction = -self._direction
+        self.value = new
+        return self.value
+
+
 class Signals(Enum):
     """Client/Server communication enum."""
 
@@ -70,36 +144,66 @@ class Signals(Enum):
     GET_TOKEN = 1
     FINISH_TRANSACTION = 2
     RUN_BATCH = 3
+    RESULTS_RECEIVED = 4
+    KEEPALIVE = 5
     # server to client
     TRANSACTION_NOT_DONE = 50
     TRANSACTION_COMPLETE = 51
     OK_TO_BEGIN = 52
     WAIT_FOR_TOKEN = 53
+    INVALID_TOKEN = 54
+    BATCH_RECEIVED = 55
+    TRANSACTION_FINISHED = 56
+    INVALID_REQUEST = 57
+    KEEPALIVE_RECEIVED = 58
+
+
+PROTOCOL_VERSION = 1
+# version, opcode, flags, sequence number, payload length, record count
+HEADER = struct.Struct('!BBHqQI')
+Header = namedtuple('Header', ['signal', 'flags', 'seq', 'length', 'count'])
 
 
-def _encode(obj):
-    """Encode for msgpack."""
-    print(obj, isinstance(obj, Signals))
-    if isinstance(obj, Signals):
-        return msgpack.ExtType(101, pickle.dumps(obj))
-    raise TypeError("Unknown type: {}".format(obj))
+def pack_header(signal, seq=0, length=0, count=0, flags=0):
+    """Pack the header frame of a message.
 
+    :param signal: a `Signals` member, the message opcode.
+    :param seq: sequence number of the message, e.g. of a batch.
+    :param length: length of the message payload in bytes.
+    :param count: number of records in the payload.
+    :param flags: bit flags, currently unused and reserved.
 
-def _decode(code, data):
-    """Decode from msgpack."""
-    if code == 101:
-        return pickle.loads(data)
-    return msgpack.ExtType(code, data)
+    :returns: bytes.
+    """
+    return HEADER.pack(
+        PROTOCOL_VERSION, signal.value, flags, seq, length, count)
+
+
+def unpack_header(frame):
+    """Unpack the header frame of a message.
+
+    :param frame: bytes-like header frame.
+
+    :returns: a `Header` of (signal, flags, seq, length, count).
+    :raises: ValueError if the frame is not a valid header, or is from an
+        incompatible protocol version.
+    """
+    if len(frame) != HEADER.size:
+        raise ValueError(f"Invalid header size: {len(frame)}.")
+    version, opcode, flags, seq, length, count = HEADER.unpack(frame)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported protocol version: {version}.")
+    return Header(Signals(opcode), flags, seq, length, count)
 
 
 def packb(message):
     """Pack data through msgpack."""
-    return msgpack.packb(message, default=_encode, use_bin_type=True)
+    return msgpack.packb(message, use_bin_type=True)
 
 
 def unpackb(message):
     """Unpack data from msgpack."""
-    return msgpack.unpackb(message, ext_hook=_decode, raw=False)
+    return msgpack.unpackb(message, raw=False)
 
 
 def cli():
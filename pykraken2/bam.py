@@ -0,0 +1,160 @@
+"""Unaligned BAM and SAM input for pykraken2 clients.
+
+Requires `pysam`, install with `pip install pykraken2[bam]`.
+"""
+
+import os
+import queue
+from threading import Event, Thread
+
+import pykraken2
+from pykraken2.output import split_lines
+
+BAM_SUFFIXES = ('.bam', '.ubam', '.sam')
+
+
+def is_bam(path):
+    """Check if a path has a BAM or SAM file suffix."""
+    return isinstance(path, (str, os.PathLike)) \
+        and os.fspath(path).lower().endswith(BAM_SUFFIXES)
+
+
+class BamReader:
+    """Iterate over the records of an (unaligned) BAM or SAM file.
+
+    Records are decoded on a background thread, with BGZF decompression
+    spread over `threads` further threads, and yielded as (id, sequence,
+    quality) tuples suitable as a source for `Client.classify`. Secondary
+    and supplementary alignments are skipped such that each read is
+    classified once, as are records without a sequence.
+
+    Selected tags may be carried through to results with `annotate`.
+    """
+
+    CHUNK_SIZE = 1000  # records passed between threads together
+    QUEUE_SIZE = 16  # chunks decoded ahead of consumption
+
+    def __init__(self, path, tags=None, threads=1):
+        """Init function.
+
+        :param path: path to BAM or SAM file.
+        :param tags: list of two-letter tags, e.g. ['RG', 'BC'], to carry
+            through to results.
+        :param threads: number of BGZF decompression threads.
+        """
+        try:
+            import pysam  # noqa: F401
+        except ImportError as e:
+            raise ImportError(
+                "Reading BAM requires pysam: "
+                "`pip install pykraken2[bam]`.") from e
+        self.logger = pykraken2.get_named_logger('BamRead')
+        self.path = path
+        self.tags = list(tags or [])
+        self.threads = threads
+        # tags of reads sent but without results, by read id
+        self.read_tags = dict()
+        # number of leading records to skip, when resuming a transaction
+        self.skip = 0
+
+    def __iter__(self):
+        """Iterate over (id, sequence, quality) records."""
+        records = queue.Queue(maxsize=self.QUEUE_SIZE)
+        stop = Event()
+        worker = Thread(target=self._decode, args=(records, stop))
+        worker.start()
+        try:
+            while True:
+                chunk = records.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield from chunk
+        finally:
+            stop.set()
+            worker.join()
+
+    def _decode(self, records, stop):
+        """Decode records into a queue, worker thread target."""
+        import pysam
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    records.put(item, timeout=0.1)
+                except queue.Full:
+                    continue
+                return True
+            return False
+
+        try:
+            with pysam.AlignmentFile(
+                    self.path, 'r', check_sq=False,
+                    threads=self.threads) as bam:
+                chunk = []
+                skip = self.skip
+                empty = 0
+                for read in bam.fetch(until_eof=True):
+                    if read.is_secondary or read.is_supplementary:
+                        continue
+                    if not read.query_sequence:
+                        empty += 1
+                        continue
+                    if skip:
+                        skip -= 1
+                        continue
+                    if self.tags:
+                        self.read_tags[read.query_name] = self._tags(read)
+                    chunk.append((
+                        read.query_name, read.query_sequence,
+                        read.query_qualities_str))
+                    if len(chunk) == self.CHUNK_SIZE:
+                        if not put(chunk):
+                            return
+                        chunk = []
+                if chunk and not put(chunk):
+                    return
+                if empty:
+                    self.logger.warning(
+                        f'Skipped {empty} records without sequence.')
+        except Exception as e:
+            self.logger.error(f'Failed to read {self.path}.')
+            put(e)
+            return
+        put(None)
+
+    def _tags(self, read):
+        """Format selected tags of a read as SAM text."""
+        tags = []
+        for tag in self.tags:
+            if read.has_tag(tag):
+                value, value_type = read.get_tag(tag, with_value_type=True)
+                if value_type.startswith('B'):
+                    # arrays are typed by their subtype, e.g. 'BC'
+                    value = ','.join(
+                        [value_type[1]] + [str(x) for x in value])
+                    value_type = 'B'
+                elif value_type in 'cCsSiI':
+                    value_type = 'i'
+                tags.append(f'{tag}:{value_type}:{value}')
+        return '\t'.join(tags)
+
+    def annotate(self, chunks):
+        """Append the selected tags of reads to kraken2 output lines.
+
+        :param chunks: iterable of chunks of kraken2 output.
+
+        :returns: a generator of chunks of kraken2 output, with the tags
+            of each read in SAM format as additional columns.
+        """
+        if not self.tags:
+            yield from chunks
+            return
+        for lines in split_lines(chunks):
+            out = []
+            for line in lines:
+                read_id = line.split('\t', 2)[1]
+                tags = self.read_tags.pop(read_id, '')
+                out.append(f'{line}\t{tags}\n' if tags else f'{line}\n')
+            yield ''.join(out)
@@ -1,25 +1,59 @@
 """pykraken2 client module."""
 
 import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
 import threading
 from threading import Thread
 import time
 
 import zmq
+import zmq.asyncio
 
 import pykraken2
-from pykraken2 import _log_level, packb, Signals, unpackb, ZMQ_MSG_SIZE
+from pykraken2 import (
+    _log_level, AdaptiveSize, MAX_MSG_SIZE, MIN_MSG_SIZE, pack_header,
+    Signals, unpack_header, unpackb, ZMQ_MSG_SIZE)
+from pykraken2.bam import BamReader, is_bam
+from pykraken2.filters import COLUMNS, ResultFilter
+from pykraken2.output import FORMATS, open_writer
+from pykraken2.sources import abatches, batches, skip_records
 
 
 class Client:
-    """Client class to stream sequence data to kraken2  server."""
+    """Client class to stream sequence data to kraken2  server.
+
+    Requests to the server are resent on a new connection if no reply
+    is received within `timeout`. With a `checkpoint` file, a transaction
+    interrupted by loss of the client process can be resumed by a new
+    client given the same checkpoint and source. Without one, the
+    transaction is always finished, such that the server is released.
+
+    Keepalives are sent every `KEEPALIVE` seconds, such that the server
+    does not reclaim the token of a client waiting on a slow source.
+    """
+
+    RETRIES = 5  # attempts at each request before giving up
+    KEEPALIVE = 30  # seconds between keepalives, less than server timeout
 
     def __init__(
-            self, address='localhost', port=5555):
+            self, address='localhost', port=5555,
+            msg_size=ZMQ_MSG_SIZE, adaptive=True,
+            min_msg_size=MIN_MSG_SIZE, max_msg_size=MAX_MSG_SIZE,
+            timeout=60, checkpoint=None):
         """Init function.
 
         :param address: server address
         :param port: server port
+        :param msg_size: (initial) size in bytes of data messages
+        :param adaptive: adapt message size to the measured throughput
+        :param min_msg_size: lower bound of adaptive message size
+        :param max_msg_size: upper bound of adaptive message size
+        :param timeout: seconds to wait for a reply from the server
+        :param checkpoint: path of file in which to record progress
         """
         self.logger = pykraken2.get_named_logger('Client')
         self.context = zmq.Context.instance()
@@ -28,6 +62,15 @@ class Client:
         self.recv_port = None
         self.terminate_event = threading.Event()
         self.token = None
+        self.msg_size = AdaptiveSize(
+            msg_size, min_msg_size, max_msg_size, adaptive=adaptive)
+        self.timeout = timeout
+        self.checkpoint = checkpoint
+        self.socket = None
+        self.result_seq = -1
+        self.resumed = False
+        self.send_error = None
+        self.transaction_complete = False
 
     def __enter__(self):
         """Enter context manager."""
@@ -43,55 +86,241 @@ class Client:
 
     def process_fastq(self, fastq):
         """Process a fastq file."""
-        self.logger.info(f'Sending on tcp://{self.address}:{self.recv_port}')
-        send_socket = self.context.socket(zmq.REQ)
-        send_socket.connect(f"tcp://{self.address}:{self.send_port}")
+        return self.classify(fastq)
+
+    def classify(self, source, result_filter=None):
+        """Classify sequences from a source.
+
+        :param source: a path to a FASTQ file, a file-like object such as
+            `sys.stdin.buffer`, a buffer of FASTQ text, or an iterable of
+            (id, sequence[, quality]) records or of FASTQ text. See
+            `pykraken2.sources.batches`. Paths to BAM or SAM files, or
+            a `pykraken2.bam.BamReader`, are decoded in the background.
+        :param result_filter: a `pykraken2.filters.ResultFilter`, applied
+            by the server such that only selected reads and columns are
+            returned.
+
+        :returns: a generator of chunks of kraken2 output. For a
+            `BamReader` with tags, chunks are whole lines annotated with
+            the tags of each read.
 
-        # poll for server to let us start
-        # TODO: change this to zmq.poll rather than explicit sleep
-        while True:
-            send_socket.send_multipart([packb(Signals.GET_TOKEN)])
-            signal, token, port = send_socket.recv_multipart()
-            signal = unpackb(signal)
+        The source is read lazily as data is sent to the server.
 
-            if signal == Signals.OK_TO_BEGIN:
-                self.token = token
+        A chunk is acknowledged to the server when the next chunk is
+        requested or the generator is closed. If the client has a
+        checkpoint from an interrupted transaction, that transaction is
+        resumed: data already received by the server is skipped, which
+        requires the source to be the same as before, and only chunks not
+        previously acknowledged are returned. `resumed` is set
+        accordingly before the first chunk is returned.
+
+        Without a checkpoint, the transaction is finished even if the
+        generator is closed early, the source raises or `terminate` is
+        called. In these cases any outstanding results are discarded.
+        """
+        if is_bam(source):
+            source = BamReader(source)
+        # tags are held until the results of their reads are returned
+        if isinstance(source, BamReader) and source.tags \
+                and result_filter is not None \
+                and (result_filter.columns is not None
+                     or result_filter.selects_reads):
+            raise ValueError(
+                "BAM tags cannot be appended to filtered or projected "
+                "results.")
+        token, result_seq = self._load_checkpoint()
+        self.socket = self._connect()
+        try:
+            # poll for server to let us start
+            while True:
+                query = [pack_header(Signals.GET_TOKEN), token or b'']
+                if result_filter is not None:
+                    query.append(result_filter.pack())
+                header, *reply = self._request(query)
+                if header.signal == Signals.OK_TO_BEGIN:
+                    break
+                elif header.signal == Signals.WAIT_FOR_TOKEN:
+                    time.sleep(1)
+                    self.logger.info('Waiting for lock on server')
+
+            new_token, port, records = reply
+            self.token = new_token
+            self.recv_port = unpackb(port)
+            batch_seq, records = header.seq, unpackb(records)
+            self.resumed = token is not None and new_token == token
+            if self.resumed:
+                self.logger.info(
+                    f'Resuming transaction after {records} records.')
+                self.result_seq = result_seq
+            else:
+                if token is not None:
+                    self.logger.warning(
+                        'Checkpointed transaction has expired, restarting.')
                 self.logger.info('Acquired server token')
-                self.recv_port = unpackb(port)
-                break
-            elif signal == Signals.WAIT_FOR_TOKEN:
-                time.sleep(1)
-                self.logger.info('Waiting for lock on server')
+                self.result_seq = -1
+            self._save_checkpoint()
+        except BaseException:
+            self.socket.close(linger=0)
+            raise
 
         # start sending and receiving
+        stop = threading.Event()
+        self.send_error = None
+        self.transaction_complete = False
+        recv_socket = self._bind_receiver()
         send_thread = Thread(
-            target=self._send_worker, args=(fastq, send_socket))
+            target=self._send_worker,
+            args=(source, batch_seq, records, stop))
         send_thread.start()
-        for chunk in self._receiver():
-            yield chunk
-        send_thread.join()
-        send_socket.close()
+        keepalive_thread = Thread(target=self._keepalive, args=(stop,))
+        keepalive_thread.start()
+        receiver = chunks = self._receiver(recv_socket)
+        if isinstance(source, BamReader):
+            chunks = source.annotate(chunks)
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            # acknowledges the chunk returned last
+            receiver.close()
+            stop.set()
+            send_thread.join()
+            keepalive_thread.join()
+            self.socket.close(linger=0)
+            # the server holds its lock until the transaction is finished,
+            # a checkpointed transaction is left open to be resumed
+            if not self.transaction_complete and self.checkpoint is None \
+                    and self._finish_transaction():
+                self._drain(recv_socket)
+            recv_socket.close(linger=0)
 
-    def _send_worker(self, fastq, socket):
+    def _connect(self):
+        """Create a socket for requests to the server."""
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(f"tcp://{self.address}:{self.send_port}")
+        return socket
+
+    def _request(self, query):
+        """Send a request to the server, reconnecting on timeout.
+
+        Requests are safe to resend: data batches are numbered so the
+        server ignores duplicates.
+
+        :returns: the reply, its header unpacked.
+        :raises ValueError: if the server rejects the request.
+        :raises IOError: if the server does not respond.
+        """
+        for _ in range(self.RETRIES):
+            self.socket.send_multipart(query, copy=False)
+            if self.socket.poll(timeout=1000 * self.timeout):
+                header, *reply = self.socket.recv_multipart()
+                header = unpack_header(header)
+                if header.signal == Signals.INVALID_TOKEN:
+                    raise ValueError('Server rejected client token.')
+                if header.signal == Signals.INVALID_REQUEST:
+                    raise ValueError('Server rejected client request.')
+                return [header, *reply]
+            self.logger.warning('No reply from server, reconnecting.')
+            # a REQ socket cannot resend, so start afresh
+            self.socket.close(linger=0)
+            self.socket = self._connect()
+        raise IOError(
+            f'Server at tcp://{self.address}:{self.send_port} '
+            'is not responding.')
+
+    def _load_checkpoint(self):
+        """Read token and last acknowledged result from checkpoint."""
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None, -1
+        with open(self.checkpoint, 'r') as fh:
+            state = json.load(fh)
+        return state['token'].encode('UTF-8'), state['result']
+
+    def _save_checkpoint(self):
+        """Record token and last acknowledged result."""
+        if self.checkpoint is None:
+            return
+        tmp = f'{self.checkpoint}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(
+                {'token': self.token.decode('UTF-8'),
+                 'result': self.result_seq}, fh)
+        os.replace(tmp, self.checkpoint)
+
+    def _send_worker(self, source, batch_seq, records, stop):
         self.logger.info("Starting to send data.")
-        with open(fastq, 'r') as fh:
-            while not self.terminate_event.is_set():
-                seq = fh.read(ZMQ_MSG_SIZE)
-                if seq:
-                    socket.send_multipart(
-                        [packb(Signals.RUN_BATCH),
-                         self.token, seq.encode('UTF-8')])
-                    socket.recv_multipart()
-                else:
-                    socket.send_multipart(
-                        [packb(Signals.FINISH_TRANSACTION),
-                         self.token])
-                    socket.recv_multipart()
+        try:
+            if isinstance(source, BamReader):
+                source.skip = records
+                messages = batches(source, self.msg_size)
+            else:
+                messages = skip_records(
+                    batches(source, self.msg_size), records)
+            for seq, data in enumerate(messages, start=batch_seq + 1):
+                if self.terminate_event.is_set() or stop.is_set():
                     break
-        self.logger.info("Sending data finished.")
+                start = time.perf_counter()
+                self._request([
+                    pack_header(
+                        Signals.RUN_BATCH, seq, len(data),
+                        data.count(b'\n') // 4),
+                    self.token, data])
+                # the round-trip covers the server writing the data to the
+                # kraken2 input pipe; it is bound by classification only
+                # once the pipe is full
+                self.msg_size.update(len(data), time.perf_counter() - start)
+            else:
+                self._request(
+                    [pack_header(Signals.FINISH_TRANSACTION), self.token])
+        except Exception as e:
+            self.logger.error('Sending data failed.')
+            self.send_error = e
+            return
+        self.logger.info(
+            "Sending data finished. "
+            f"Final message size: {self.msg_size.value}.")
+
+    def _keepalive(self, stop):
+        """Keep the transaction alive until `stop` is set.
+
+        Uses a socket of its own as requests of the send thread may block
+        on the source.
+        """
+        socket = self._connect()
+        try:
+            while not stop.wait(self.KEEPALIVE):
+                socket.send_multipart(
+                    [pack_header(Signals.KEEPALIVE), self.token])
+                while not stop.is_set():
+                    if socket.poll(timeout=1000):
+                        socket.recv_multipart()
+                        break
+        finally:
+            socket.close(linger=0)
+
+    def _finish_transaction(self):
+        """Tell the server all data has been sent.
 
-    def _receiver(self):
-        """Worker to receive results."""
+        A new socket is used as an interrupted request leaves a REQ socket
+        unable to send.
+
+        :returns: True if the server accepted the request.
+        """
+        socket = self._connect()
+        try:
+            socket.send_multipart(
+                [pack_header(Signals.FINISH_TRANSACTION), self.token])
+            if socket.poll(timeout=1000 * self.timeout):
+                header, *_ = socket.recv_multipart()
+                return unpack_header(header).signal \
+                    == Signals.TRANSACTION_FINISHED
+            self.logger.error('Server did not acknowledge end of data.')
+            return False
+        finally:
+            socket.close(linger=0)
+
+    def _bind_receiver(self):
+        """Bind the socket on which results are received."""
         self.logger.info(f'Receiving on tcp://{self.address}:{self.recv_port}')
         socket = self.context.socket(zmq.REP)
 
@@ -108,39 +337,360 @@ class Client:
                 break
             time.sleep(1)
         self.logger.info("Receiver bound to socket.")
+        return socket
+
+    def _receiver(self, socket):
+        """Worker to receive results.
 
+        Results already acknowledged, and resent by the server as the
+        acknowledgement was lost, are ignored.
+        """
         poller = zmq.Poller()
         poller.register(socket, flags=zmq.POLLIN)
-        while not self.terminate_event.is_set():
-            if poller.poll(timeout=1000):
-                msg, token, payload = socket.recv_multipart()
+        pending = None
+        try:
+            while not self.terminate_event.is_set():
+                if not poller.poll(timeout=1000):
+                    if self.send_error is not None:
+                        raise self.send_error
+                    continue
+                header, token, payload = socket.recv_multipart()
+                header = unpack_header(header)
                 if token != self.token:
                     raise ValueError(
                         "Client received results with incorrect token")
-                status = unpackb(msg)
-                socket.send(b'Received')
+                status, seq = header.signal, header.seq
+                if seq <= self.result_seq:
+                    socket.send(pack_header(Signals.RESULTS_RECEIVED, seq))
+                    continue
 
-                result = payload.decode('UTF-8')
-                yield result
+                pending = seq
+                yield payload.decode('UTF-8')
+                self._acknowledge(socket, seq)
+                pending = None
 
                 if status == Signals.TRANSACTION_COMPLETE:
                     self.logger.debug(
                         'Received TRANSACTION_COMPLETE message.')
+                    self.transaction_complete = True
+                    if self.checkpoint is not None:
+                        os.remove(self.checkpoint)
                     break
                 elif status == Signals.TRANSACTION_NOT_DONE:
                     self.logger.debug(
                         'Received TRANSACTION_NOT_DONE message.')
                     continue
-        socket.close()
+        finally:
+            if pending is not None:
+                self._acknowledge(socket, pending)
         self.logger.info("Receive data thread finished.")
 
+    def _acknowledge(self, socket, seq):
+        """Acknowledge receipt of results to the server."""
+        self.result_seq = seq
+        self._save_checkpoint()
+        socket.send(pack_header(Signals.RESULTS_RECEIVED, seq))
+
+    def _drain(self, socket):
+        """Discard results until the server completes the transaction."""
+        self.logger.info('Discarding outstanding results.')
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            if not socket.poll(timeout=1000):
+                continue
+            header, token, *_ = socket.recv_multipart()
+            header = unpack_header(header)
+            socket.send(pack_header(Signals.RESULTS_RECEIVED, header.seq))
+            if token == self.token \
+                    and header.signal == Signals.TRANSACTION_COMPLETE:
+                self.transaction_complete = True
+                return
+        self.logger.error(
+            'Server did not complete transaction within '
+            f'{self.timeout}s.')
+
+
+class AsyncClient:
+    """asyncio client to stream sequence data to a kraken2 server.
+
+    Many instances may be run concurrently in a single event loop, the
+    server will process their samples in turn. Keepalives are sent every
+    `KEEPALIVE` seconds, such that the server does not reclaim the token
+    of a client waiting on a slow source.
+    """
+
+    TIMEOUT = 60  # seconds to wait for the server when finishing early
+    KEEPALIVE = 30  # seconds between keepalives, less than server timeout
+
+    def __init__(
+            self, address='localhost', port=5555,
+            msg_size=ZMQ_MSG_SIZE, adaptive=True,
+            min_msg_size=MIN_MSG_SIZE, max_msg_size=MAX_MSG_SIZE):
+        """Init function.
+
+        :param address: server address
+        :param port: server port
+        :param msg_size: (initial) size in bytes of data messages
+        :param adaptive: adapt message size to the measured throughput
+        :param min_msg_size: lower bound of adaptive message size
+        :param max_msg_size: upper bound of adaptive message size
+        """
+        self.logger = pykraken2.get_named_logger('AClient')
+        self.context = zmq.asyncio.Context.instance()
+        self.address = address
+        self.send_port = port
+        self.recv_port = None
+        self.terminate_event = asyncio.Event()
+        self.token = None
+        self.result_seq = -1
+        self.msg_size = AdaptiveSize(
+            msg_size, min_msg_size, max_msg_size, adaptive=adaptive)
+
+    async def __aenter__(self):
+        """Enter context manager."""
+        return self
+
+    async def __aexit__(self, etype, value, traceback):
+        """Exit context manager."""
+        self.terminate()
+
+    def terminate(self):
+        """Terminate the client."""
+        self.terminate_event.set()
+
+    async def classify(self, source, result_filter=None):
+        """Classify sequences from a source.
+
+        :param source: a path to a FASTQ file, a file-like object or an
+            async iterable of FASTQ records or chunks. See
+            `pykraken2.sources.abatches`.
+        :param result_filter: a `pykraken2.filters.ResultFilter`, applied
+            by the server such that only selected reads and columns are
+            returned.
+
+        :returns: an async generator of chunks of kraken2 output.
+
+        The transaction with the server is always finished, even if the
+        generator is closed early, the source raises or `terminate` is
+        called. In these cases any outstanding results are discarded.
+        """
+        send_socket = self.context.socket(zmq.REQ)
+        send_socket.connect(f"tcp://{self.address}:{self.send_port}")
+        recv_socket = None
+        sender = None
+        keepalive = None
+        self.transaction_complete = False
+        query = [pack_header(Signals.GET_TOKEN), b'']
+        if result_filter is not None:
+            query.append(result_filter.pack())
+        try:
+            while not self.terminate_event.is_set():
+                await send_socket.send_multipart(query)
+                header, *reply = await send_socket.recv_multipart()
+                signal = unpack_header(header).signal
+                if signal == Signals.INVALID_REQUEST:
+                    raise ValueError('Server rejected client request.')
+                if signal == Signals.OK_TO_BEGIN:
+                    token, port, _ = reply
+                    self.token = token
+                    self.logger.info('Acquired server token')
+                    self.recv_port = unpackb(port)
+                    self.result_seq = -1
+                    break
+                self.logger.info('Waiting for lock on server')
+                await asyncio.sleep(1)
+            else:
+                return
+
+            keepalive = asyncio.create_task(self._keepalive())
+            recv_socket = await self._bind_receiver()
+            sender = asyncio.create_task(
+                self._send_worker(source, send_socket))
+            async for chunk in self._receiver(recv_socket, sender):
+                yield chunk
+            await sender
+        finally:
+            if keepalive is not None:
+                keepalive.cancel()
+                await asyncio.gather(keepalive, return_exceptions=True)
+            if sender is not None:
+                if not sender.done():
+                    sender.cancel()
+                await asyncio.gather(sender, return_exceptions=True)
+                if not self.transaction_complete:
+                    await self._drain(recv_socket)
+            if recv_socket is not None:
+                recv_socket.close(linger=0)
+            send_socket.close(linger=0)
+
+    async def _send_worker(self, source, socket):
+        self.logger.info("Starting to send data.")
+        try:
+            seq = 0
+            async for data in abatches(source, self.msg_size):
+                if self.terminate_event.is_set():
+                    break
+                start = time.perf_counter()
+                await socket.send_multipart([
+                    pack_header(
+                        Signals.RUN_BATCH, seq, len(data),
+                        data.count(b'\n') // 4),
+                    self.token, data], copy=False)
+                header, *_ = await socket.recv_multipart()
+                if unpack_header(header).signal == Signals.INVALID_TOKEN:
+                    raise ValueError('Server rejected client token.')
+                self.msg_size.update(len(data), time.perf_counter() - start)
+                seq += 1
+        finally:
+            # the server holds its lock until the transaction is finished
+            await self._finish_transaction()
+        self.logger.info("Sending data finished.")
+
+    async def _keepalive(self):
+        """Keep the transaction alive until cancelled."""
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(f"tcp://{self.address}:{self.send_port}")
+        try:
+            while True:
+                await asyncio.sleep(self.KEEPALIVE)
+                await socket.send_multipart(
+                    [pack_header(Signals.KEEPALIVE), self.token])
+                await socket.recv_multipart()
+        finally:
+            socket.close(linger=0)
+
+    async def _finish_transaction(self):
+        """Tell the server all data has been sent.
+
+        A new socket is used as a cancelled request leaves a REQ socket
+        unable to send.
+        """
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(f"tcp://{self.address}:{self.send_port}")
+        try:
+            await socket.send_multipart(
+                [pack_header(Signals.FINISH_TRANSACTION), self.token])
+            if await socket.poll(timeout=1000 * self.TIMEOUT):
+                await socket.recv_multipart()
+            else:
+                self.logger.error('Server did not acknowledge end of data.')
+        finally:
+            socket.close(linger=0)
+
+    async def _bind_receiver(self):
+        """Bind the socket on which results are received."""
+        socket = self.context.socket(zmq.REP)
+        # the port may still be held by a previous client of the server
+        while not self.terminate_event.is_set():
+            try:
+                socket.bind(f'tcp://{self.address}:{self.recv_port}')
+            except zmq.error.ZMQError:
+                self.logger.debug(
+                    'Waiting to bind to '
+                    f'tcp://{self.address}:{self.recv_port}')
+                await asyncio.sleep(1)
+            else:
+                break
+        self.logger.info("Receiver bound to socket.")
+        return socket
+
+    async def _receiver(self, socket, sender):
+        """Receive results."""
+        while not self.terminate_event.is_set():
+            if not await socket.poll(timeout=1000):
+                if sender.done() and sender.exception() is not None:
+                    raise sender.exception()
+                continue
+            header, token, payload = await socket.recv_multipart()
+            header = unpack_header(header)
+            if token != self.token:
+                raise ValueError(
+                    "Client received results with incorrect token")
+            status, seq = header.signal, header.seq
+            await socket.send(pack_header(Signals.RESULTS_RECEIVED, seq))
+            if seq <= self.result_seq:
+                # resent as the acknowledgement was lost
+                continue
+            self.result_seq = seq
+            if status == Signals.TRANSACTION_COMPLETE:
+                self.logger.debug('Received TRANSACTION_COMPLETE message.')
+                self.transaction_complete = True
+
+            yield payload.decode('UTF-8')
+
+            if self.transaction_complete:
+                break
+        self.logger.info("Receive data finished.")
+
+    async def _drain(self, socket):
+        """Discard results until the server completes the transaction."""
+        self.logger.info('Discarding outstanding results.')
+        deadline = time.monotonic() + self.TIMEOUT
+        while time.monotonic() < deadline:
+            if not await socket.poll(timeout=1000):
+                continue
+            header, token, *_ = await socket.recv_multipart()
+            header = unpack_header(header)
+            await socket.send(
+                pack_header(Signals.RESULTS_RECEIVED, header.seq))
+            if token == self.token \
+                    and header.signal == Signals.TRANSACTION_COMPLETE:
+                self.transaction_complete = True
+                return
+        self.logger.error(
+            'Server did not complete transaction within '
+            f'{self.TIMEOUT}s.')
+
 
 def main(args):
     """Entry point to run a kraken2 client."""
-    with Client(args.address, args.ports) as client:
-        with open(args.out, 'w') as fh:
-            for chunk in client.process_fastq(args.fastq):
-                fh.write(chunk)
+    columns = args.columns
+    writer_args = dict()
+    if args.format != 'text':
+        if columns is not None or args.bam_tags:
+            raise ValueError(
+                f"--columns and --bam-tags are not supported with "
+                f"--format {args.format}.")
+        if args.checkpoint is not None:
+            raise ValueError(
+                f"--checkpoint is not supported with --format {args.format}.")
+        writer_args = dict(
+            kmers=args.kmers, row_group_size=args.row_group_size)
+        if args.compression is not None:
+            writer_args['compression'] = args.compression
+        if args.format == 'parquet':
+            writer_args['dictionary'] = not args.no_dictionary
+        if not args.kmers:
+            # the k-mer column is not needed, so need not be sent
+            columns = COLUMNS[:4]
+    with Client(
+            args.address, args.port, msg_size=args.msg_size,
+            adaptive=not args.fixed_msg_size, timeout=args.timeout,
+            checkpoint=args.checkpoint) as client:
+        if args.fastq == '-':
+            source = sys.stdin.buffer
+        elif is_bam(args.fastq):
+            source = BamReader(
+                args.fastq, tags=args.bam_tags, threads=args.bam_threads)
+        else:
+            source = args.fastq
+        result_filter = None
+        if args.classified_only or args.taxids is not None \
+                or args.min_confidence is not None \
+                or columns is not None:
+            result_filter = ResultFilter(
+                classified_only=args.classified_only, taxids=args.taxids,
+                min_confidence=args.min_confidence, columns=columns)
+        results = client.classify(source, result_filter=result_filter)
+        # peek the first chunk to know if output so far should be kept
+        first = next(results, '')
+        if args.format == 'text':
+            writer_args['append'] = client.resumed
+        with open_writer(args.out, args.format, **writer_args) as writer:
+            # text is flushed for each chunk, results are acknowledged on
+            # requesting the next chunk
+            for chunk in itertools.chain([first], results):
+                writer.write(chunk)
 
 
 def argparser():
@@ -151,14 +701,74 @@ def argparser():
         parents=[_log_level()], add_help=False)
     parser.add_argument(
         "fastq",
-        help="Input fastq file.")
+        help=(
+            "Input fastq, or unaligned BAM or SAM, file, "
+            "or '-' to read fastq from stdin."))
     parser.add_argument(
         "--address", default='localhost',
         help="Server address.")
     parser.add_argument(
-        "--port", default=5555,
+        "--port", default=5555, type=int,
         help="Server port.")
+    parser.add_argument(
+        "--msg-size", default=ZMQ_MSG_SIZE, type=int,
+        help="Initial size in bytes of messages sent to the server.")
+    parser.add_argument(
+        "--fixed-msg-size", action="store_true",
+        help="Do not adapt message size to the measured throughput.")
+    parser.add_argument(
+        "--bam-tags", nargs='+', default=[],
+        help=(
+            "Tags of BAM input reads to append to results, e.g. RG BC. "
+            "Not supported with filters or --columns."))
+    parser.add_argument(
+        "--bam-threads", default=2, type=int,
+        help="Decompression threads for BAM input.")
+    parser.add_argument(
+        "--timeout", default=60, type=int,
+        help="Seconds to wait for a server reply before reconnecting.")
+    parser.add_argument(
+        "--checkpoint",
+        help=(
+            "File in which to record progress. If the file exists, the "
+            "interrupted transaction is resumed and results appended to "
+            "the output."))
+    parser.add_argument(
+        "--classified-only", action="store_true",
+        help="Return only classified reads.")
+    parser.add_argument(
+        "--taxids", nargs='+', type=int,
+        help="Return only reads assigned to these taxa or their descendants.")
+    parser.add_argument(
+        "--min-confidence", type=float,
+        help=(
+            "Return only reads for which this fraction of k-mers lie in "
+            "the clade of the assigned taxon."))
+    parser.add_argument(
+        "--columns", nargs='+', choices=COLUMNS,
+        help="Columns of results to return, in order.")
     parser.add_argument(
         "--out", default="pykraken2_out.txt",
         help="Output file.")
+    parser.add_argument(
+        "--format", default='text', choices=list(FORMATS),
+        help=(
+            "Output format. Parquet and Arrow IPC require pyarrow. "
+            "Columnar formats cannot be appended to so are not "
+            "resumable."))
+    parser.add_argument(
+        "--kmers", action="store_true",
+        help="Write k-mer hits of each read to columnar formats.")
+    parser.add_argument(
+        "--row-group-size", default=100000, type=int,
+        help="Number of reads in each row group of columnar formats.")
+    parser.add_argument(
+        "--compression",
+        help=(
+            "Compression of columnar formats, e.g. zstd or snappy for "
+            "Parquet, zstd or lz4 for Arrow, gzip for binary. Defaults to "
+            "zstd for Parquet, none otherwise."))
+    parser.add_argument(
+        "--no-dictionary", action="store_true",
+        help="Disable dictionary encoding of Parquet columns.")
     return parser
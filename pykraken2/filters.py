@@ -0,0 +1,154 @@
+"""Filtering and projection of kraken2 results on the server.
+
+A client may ask the server to return only some reads, and only some
+columns of each, such that results not wanted are never sent.
+"""
+
+import pykraken2
+
+# columns of kraken2 standard output
+COLUMNS = ('classified', 'read_id', 'taxid', 'length', 'kmers')
+
+
+def confidence(taxid, kmers, taxonomy):
+    """Calculate the confidence of a read's classification.
+
+    :param taxid: taxon to which the read is assigned.
+    :param kmers: the k-mer column of kraken2 output for the read,
+        e.g. '0:10 562:5 A:2'.
+    :param taxonomy: a `pykraken2.taxonomy.Taxonomy`.
+
+    :returns: the fraction of the read's k-mers assigned to the clade
+        rooted at `taxid`, as used by kraken2's `--confidence`. Ambiguous
+        k-mers count towards the total, the paired read separator does not.
+        Taxa not in the taxonomy, as from a mismatched database, are
+        outside any clade.
+    """
+    if not taxid or taxid not in taxonomy:
+        return 0.0
+    total = clade = 0
+    for hit in kmers.split():
+        hit_taxid, count = hit.split(':')
+        if hit_taxid == '|':
+            continue
+        count = int(count)
+        total += count
+        if hit_taxid in ('0', 'A'):
+            continue
+        hit_taxid = int(hit_taxid)
+        if hit_taxid in taxonomy and taxonomy.is_ancestor(taxid, hit_taxid):
+            clade += count
+    return clade / total if total else 0.0
+
+
+class ResultFilter:
+    """Select reads and columns of kraken2 output.
+
+    Filters are combined, a read must pass all of them to be kept.
+    """
+
+    def __init__(
+            self, classified_only=False, taxids=None, min_confidence=None,
+            columns=None):
+        """Init function.
+
+        :param classified_only: keep only classified reads.
+        :param taxids: keep only reads assigned to one of these taxa or
+            their descendants.
+        :param min_confidence: keep only reads with at least this
+            confidence, see `confidence`.
+        :param columns: columns to keep, in order, from `COLUMNS`, e.g.
+            ['read_id', 'taxid']. All are kept by default.
+
+        :raises ValueError: for invalid options.
+        """
+        if min_confidence is not None and not 0 <= min_confidence <= 1:
+            raise ValueError("min_confidence must be between 0 and 1.")
+        if columns is not None:
+            columns = list(columns)
+            unknown = set(columns) - set(COLUMNS)
+            if not columns or unknown:
+                raise ValueError(
+                    f"columns must be a non-empty subset of {COLUMNS}.")
+        self.classified_only = bool(classified_only)
+        self.taxids = None if taxids is None else sorted(map(int, taxids))
+        self.min_confidence = min_confidence
+        self.columns = columns
+        self._indices = None if columns is None else [
+            COLUMNS.index(column) for column in columns]
+        self._taxonomy = None
+        self._subtree = None
+
+    def __eq__(self, other):
+        """Compare filters."""
+        return isinstance(other, ResultFilter) \
+            and self.as_dict() == other.as_dict()
+
+    def as_dict(self):
+        """Return filter options as a dictionary."""
+        return {
+            'classified_only': self.classified_only,
+            'taxids': self.taxids,
+            'min_confidence': self.min_confidence,
+            'columns': self.columns}
+
+    def pack(self):
+        """Serialise the filter for sending to the server."""
+        return pykraken2.packb(self.as_dict())
+
+    @classmethod
+    def unpack(cls, data):
+        """Deserialise a filter.
+
+        :raises ValueError: if `data` is not a valid filter.
+        """
+        try:
+            options = pykraken2.unpackb(data)
+            return cls(**options)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid result filter: {e}") from e
+
+    @property
+    def selects_reads(self):
+        """Check if the filter may remove reads."""
+        return self.classified_only or self.needs_taxonomy
+
+    @property
+    def needs_taxonomy(self):
+        """Check if the filter requires the database taxonomy."""
+        return self.taxids is not None or bool(self.min_confidence)
+
+    def bind(self, taxonomy):
+        """Set the taxonomy against which reads are filtered.
+
+        :param taxonomy: a `pykraken2.taxonomy.Taxonomy`.
+
+        :raises KeyError: if a filtered taxon is not in the taxonomy.
+        """
+        self._taxonomy = taxonomy
+        if self.taxids is not None:
+            self._subtree = taxonomy.subtree(self.taxids)
+
+    def apply(self, line):
+        """Filter and project a line of kraken2 output.
+
+        :param line: a line of kraken2 output.
+
+        :returns: the line, with only the selected columns, or None if
+            the read is filtered out.
+        """
+        if self.classified_only and not line.startswith('C'):
+            return None
+        if self._indices is None and not self.needs_taxonomy:
+            return line
+        fields = line.rstrip('\n').split('\t')
+        if self.needs_taxonomy:
+            taxid = int(fields[2])
+            if self._subtree is not None and taxid not in self._subtree:
+                return None
+            if self.min_confidence and confidence(
+                    taxid, fields[4], self._taxonomy) < self.min_confidence:
+                return None
+        if self._indices is None:
+            return line
+        return '\t'.join(fields[i] for i in self._indices) + '\n'
@@ -0,0 +1,418 @@
+"""Writers of kraken2 results.
+
+Results are written incrementally as chunks arrive from the server.
+Besides kraken2's own text, results may be written as Parquet or Arrow
+IPC files, which requires `pyarrow` (`pip install pykraken2[arrow]`),
+or in a compact binary format based on msgpack.
+
+Columnar formats share a typed schema:
+
+    read_id     string
+    classified  bool
+    taxid       uint64
+    length      uint32
+    kmers       list of {taxid: int64, count: uint32}, optional
+
+Ambiguous k-mers ('A' in kraken2 output) have the taxid `AMBIGUOUS` and
+the separator between mates of paired reads the taxid `MATE_SEPARATOR`.
+The length of a paired read is the sum of the lengths of its mates.
+"""
+
+import abc
+import gzip
+import os
+
+import msgpack
+
+AMBIGUOUS = -1
+MATE_SEPARATOR = -2
+BINARY_MAGIC = 'pykraken2-results'
+BINARY_VERSION = 1
+
+
+def parse_kmers(kmers):
+    """Parse the k-mer column of kraken2 output.
+
+    :param kmers: e.g. '0:10 562:5 A:2'.
+
+    :returns: tuple of (taxids, counts) lists.
+    """
+    taxids, counts = [], []
+    for hit in kmers.split():
+        taxid, count = hit.split(':')
+        if taxid == 'A':
+            taxids.append(AMBIGUOUS)
+        elif taxid == '|':
+            taxids.append(MATE_SEPARATOR)
+            count = 0
+        else:
+            taxids.append(int(taxid))
+        counts.append(int(count))
+    return taxids, counts
+
+
+class LineSplitter:
+    """Split chunks of kraken2 output into whole lines.
+
+    Chunks from the server need not end on a line boundary, the end of a
+    chunk is held until the line is completed by the next.
+    """
+
+    def __init__(self):
+        """Init function."""
+        self.partial = ''
+
+    def split(self, chunk):
+        """Return the lines completed by a chunk, without newlines."""
+        lines = (self.partial + chunk).split('\n')
+        self.partial = lines.pop()
+        return lines
+
+    def remainder(self):
+        """Return the final line, if it is not terminated, as a list."""
+        lines = [self.partial] if self.partial else []
+        self.partial = ''
+        return lines
+
+
+def split_lines(chunks):
+    """Split chunks of kraken2 output into whole lines.
+
+    :param chunks: iterable of chunks of kraken2 output, lines may be
+        split across chunks.
+
+    :returns: a generator of lists of the lines completed by each chunk,
+        without newlines, followed by one of any unterminated final line.
+    """
+    splitter = LineSplitter()
+    for chunk in chunks:
+        yield splitter.split(chunk)
+    remainder = splitter.remainder()
+    if remainder:
+        yield remainder
+
+
+class _Columns:
+    """Results accumulated column-wise."""
+
+    def __init__(self, kmers):
+        self.kmers = kmers
+        self.read_id = []
+        self.classified = []
+        self.taxid = []
+        self.length = []
+        # k-mers flattened, with offsets into the flat lists for each read
+        self.kmer_offsets = [0]
+        self.kmer_taxid = []
+        self.kmer_count = []
+
+    def __len__(self):
+        return len(self.read_id)
+
+    def add(self, line):
+        """Add a line of kraken2 output."""
+        fields = line.rstrip('\n').split('\t')
+        self.classified.append(fields[0] == 'C')
+        self.read_id.append(fields[1])
+        self.taxid.append(int(fields[2]))
+        self.length.append(sum(int(x) for x in fields[3].split('|')))
+        if self.kmers:
+            taxids, counts = parse_kmers(fields[4])
+            self.kmer_taxid.extend(taxids)
+            self.kmer_count.extend(counts)
+            self.kmer_offsets.append(len(self.kmer_taxid))
+
+
+class ResultWriter(abc.ABC):
+    """Base class of writers of columnar kraken2 results.
+
+    Chunks of kraken2 output are given to `write`, lines need not be
+    whole. Results are accumulated and written in row groups of up to
+    `row_group_size` reads.
+    """
+
+    def __init__(self, path, kmers=False, row_group_size=100000):
+        """Init function.
+
+        :param path: output file.
+        :param kmers: write the k-mer hits of each read.
+        :param row_group_size: number of reads written together.
+        """
+        self.path = path
+        self.kmers = kmers
+        self.row_group_size = row_group_size
+        self._columns = _Columns(kmers)
+        self._lines = LineSplitter()
+
+    def __enter__(self):
+        """Enter context manager."""
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        """Exit context manager."""
+        self.close()
+
+    def write(self, chunk):
+        """Write a chunk of kraken2 output."""
+        self._add(self._lines.split(chunk))
+
+    def _add(self, lines):
+        for line in lines:
+            self._columns.add(line)
+            if len(self._columns) == self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        """Write accumulated results."""
+        if len(self._columns):
+            self._write_columns(self._columns)
+            self._columns = _Columns(self.kmers)
+
+    def close(self):
+        """Write remaining results and close the file."""
+        self._add(self._lines.remainder())
+        self.flush()
+        self._close()
+
+    @abc.abstractmethod
+    def _write_columns(self, columns):
+        """Write a row group."""
+
+    @abc.abstractmethod
+    def _close(self):
+        """Close the file."""
+
+
+class TextWriter:
+    """Write kraken2 output as is."""
+
+    def __init__(self, path, append=False):
+        """Init function.
+
+        :param path: output file.
+        :param append: append to an existing file.
+        """
+        self.path = path
+        self.fh = open(path, 'a' if append else 'w')
+
+    def __enter__(self):
+        """Enter context manager."""
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        """Exit context manager."""
+        self.close()
+
+    def write(self, chunk):
+        """Write a chunk of kraken2 output."""
+        self.fh.write(chunk)
+        self.fh.flush()
+
+    def close(self):
+        """Close the file."""
+        self.fh.close()
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError(
+            "Writing Parquet or Arrow requires pyarrow: "
+            "`pip install pykraken2[arrow]`.") from e
+    return pyarrow
+
+
+def schema(kmers=False):
+    """Return the Arrow schema of results.
+
+    :param kmers: include the k-mer hits column.
+    """
+    pa = _pyarrow()
+    fields = [
+        pa.field('read_id', pa.string(), nullable=False),
+        pa.field('classified', pa.bool_(), nullable=False),
+        pa.field('taxid', pa.uint64(), nullable=False),
+        pa.field('length', pa.uint32(), nullable=False)]
+    if kmers:
+        fields.append(pa.field('kmers', pa.list_(pa.struct([
+            pa.field('taxid', pa.int64(), nullable=False),
+            pa.field('count', pa.uint32(), nullable=False)]))))
+    return pa.schema(fields)
+
+
+class _ArrowWriter(ResultWriter):
+    """Base class of writers using pyarrow."""
+
+    def __init__(self, path, kmers=False, row_group_size=100000):
+        """Init function.
+
+        :param path: output file.
+        :param kmers: write the k-mer hits of each read.
+        :param row_group_size: number of reads written together.
+        """
+        self.pa = _pyarrow()
+        super().__init__(path, kmers=kmers, row_group_size=row_group_size)
+        self.schema = schema(kmers)
+
+    def _batch(self, columns):
+        """Convert results to an Arrow record batch."""
+        pa = self.pa
+        arrays = [
+            pa.array(columns.read_id, pa.string()),
+            pa.array(columns.classified, pa.bool_()),
+            pa.array(columns.taxid, pa.uint64()),
+            pa.array(columns.length, pa.uint32())]
+        if self.kmers:
+            hits = pa.StructArray.from_arrays(
+                [pa.array(columns.kmer_taxid, pa.int64()),
+                 pa.array(columns.kmer_count, pa.uint32())],
+                fields=list(self.schema.field('kmers').type.value_type))
+            arrays.append(pa.ListArray.from_arrays(
+                pa.array(columns.kmer_offsets, pa.int32()), hits,
+                type=self.schema.field('kmers').type))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+class ParquetWriter(_ArrowWriter):
+    """Write results to a Parquet file."""
+
+    def __init__(
+            self, path, kmers=False, row_group_size=100000,
+            compression='zstd', dictionary=True):
+        """Init function.
+
+        :param path: output file.
+        :param kmers: write the k-mer hits of each read.
+        :param row_group_size: number of reads in each row group.
+        :param compression: codec, e.g. 'zstd', 'snappy' or None.
+        :param dictionary: dictionary encode columns; True for all, or a
+            list of column names.
+        """
+        super().__init__(path, kmers=kmers, row_group_size=row_group_size)
+        import pyarrow.parquet as pq
+        self.writer = pq.ParquetWriter(
+            os.fspath(path), self.schema, compression=compression or 'none',
+            use_dictionary=dictionary)
+
+    def _write_columns(self, columns):
+        self.writer.write_batch(self._batch(columns))
+
+    def _close(self):
+        self.writer.close()
+
+
+class ArrowWriter(_ArrowWriter):
+    """Write results to an Arrow IPC file."""
+
+    def __init__(
+            self, path, kmers=False, row_group_size=100000,
+            compression=None):
+        """Init function.
+
+        :param path: output file.
+        :param kmers: write the k-mer hits of each read.
+        :param row_group_size: number of reads in each record batch.
+        :param compression: codec, 'zstd', 'lz4' or None.
+        """
+        super().__init__(path, kmers=kmers, row_group_size=row_group_size)
+        self.writer = self.pa.ipc.new_file(
+            os.fspath(path), self.schema,
+            options=self.pa.ipc.IpcWriteOptions(compression=compression))
+
+    def _write_columns(self, columns):
+        self.writer.write_batch(self._batch(columns))
+
+    def _close(self):
+        self.writer.close()
+
+
+class BinaryWriter(ResultWriter):
+    """Write results in a compact binary format.
+
+    The file is a stream of msgpack objects: a header map, then a map
+    of columns for each row group. k-mers are stored flattened, as
+    `kmer_taxid` and `kmer_count` lists with `kmer_offsets` into these
+    for each read. Read back with `read_binary`.
+    """
+
+    def __init__(
+            self, path, kmers=False, row_group_size=100000,
+            compression=None):
+        """Init function.
+
+        :param path: output file.
+        :param kmers: write the k-mer hits of each read.
+        :param row_group_size: number of reads in each row group.
+        :param compression: None or 'gzip'.
+        """
+        super().__init__(path, kmers=kmers, row_group_size=row_group_size)
+        if compression == 'gzip':
+            self.fh = gzip.open(path, 'wb')
+        elif compression is None:
+            self.fh = open(path, 'wb')
+        else:
+            raise ValueError(f"Unsupported compression: {compression}.")
+        self.packer = msgpack.Packer(use_bin_type=True)
+        self.fh.write(self.packer.pack({
+            'format': BINARY_MAGIC, 'version': BINARY_VERSION,
+            'kmers': kmers}))
+
+    def _write_columns(self, columns):
+        group = {
+            'read_id': columns.read_id,
+            'classified': columns.classified,
+            'taxid': columns.taxid,
+            'length': columns.length}
+        if self.kmers:
+            group.update({
+                'kmer_offsets': columns.kmer_offsets,
+                'kmer_taxid': columns.kmer_taxid,
+                'kmer_count': columns.kmer_count})
+        self.fh.write(self.packer.pack(group))
+
+    def _close(self):
+        self.fh.close()
+
+
+def read_binary(path):
+    """Read a file written by `BinaryWriter`.
+
+    :param path: input file, optionally gzip compressed.
+
+    :returns: a generator of row groups, maps of column name to list.
+    :raises ValueError: if the file is not in the expected format.
+    """
+    with open(path, 'rb') as fh:
+        gzipped = fh.read(2) == b'\x1f\x8b'
+    with (gzip.open if gzipped else open)(path, 'rb') as fh:
+        groups = msgpack.Unpacker(fh, raw=False)
+        header = next(groups, None)
+        if not isinstance(header, dict) \
+                or header.get('format') != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a pykraken2 results file.")
+        if header['version'] != BINARY_VERSION:
+            raise ValueError(
+                f"Unsupported results file version: {header['version']}.")
+        yield from groups
+
+
+FORMATS = {
+    'text': TextWriter,
+    'parquet': ParquetWriter,
+    'arrow': ArrowWriter,
+    'binary': BinaryWriter}
+
+
+def open_writer(path, fmt='text', **kwargs):
+    """Create a writer of results.
+
+    :param path: output file.
+    :param fmt: one of `FORMATS`.
+    :param kwargs: options for the writer.
+    """
+    try:
+        writer = FORMATS[fmt]
+    except KeyError:
+        raise ValueError(f"Unknown output format: {fmt}.") from None
+    return writer(path, **kwargs)
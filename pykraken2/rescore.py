@@ -0,0 +1,271 @@
+"""Re-score kraken2 results at other confidence thresholds.
+
+kraken2 applies its `--confidence` threshold when classifying, but the
+k-mer hits of each read in its output, with the database taxonomy, are
+sufficient to recompute the classification at any threshold. This
+follows kraken2's `ResolveTree`: the taxon whose root-to-leaf path has
+most hits is chosen, the lowest common ancestor of ties, and is then
+moved up the taxonomy until its clade holds at least the threshold
+fraction of the read's k-mers. Reads are processed together with numpy.
+
+kraken2 also voids calls supported by fewer than `--minimum-hit-groups`
+groups of minimizers, which cannot be recovered from its output; such
+reads may be classified when re-scored.
+
+Requires `numpy`, install with `pip install pykraken2[rescore]`.
+"""
+
+import warnings
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError(
+        "Re-scoring requires numpy: `pip install pykraken2[rescore]`.") from e
+
+from pykraken2.output import AMBIGUOUS, MATE_SEPARATOR, split_lines
+from pykraken2.taxonomy import Taxonomy
+
+
+def kmer_arrays(lines):
+    """Parse the k-mer columns of kraken2 output.
+
+    :param lines: sequence of lines of kraken2 output.
+
+    :returns: tuple of (offsets, taxids, counts) arrays. The hits of read
+        `i` are at `offsets[i]:offsets[i + 1]` of `taxids` and `counts`.
+        Ambiguous k-mers have the taxid `AMBIGUOUS` and the separator of
+        paired reads `MATE_SEPARATOR`, with a count of zero.
+    """
+    kmers = [line.split('\t', 5)[4] for line in lines]
+    sizes = [x.count(':') for x in kmers]
+    text = ' '.join(kmers).replace('|:|', f'{MATE_SEPARATOR}:0') \
+        .replace('A:', f'{AMBIGUOUS}:').replace(':', ' ')
+    with warnings.catch_warnings():
+        # numpy warns, rather than raises, on unparsable text
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(text, dtype=np.int64, sep=' ')
+        except (DeprecationWarning, ValueError) as e:
+            raise ValueError("Invalid k-mer column in kraken2 output.") \
+                from e
+    if len(values) != 2 * sum(sizes):
+        raise ValueError("Invalid k-mer column in kraken2 output.")
+    offsets = np.zeros(len(kmers) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets, values[0::2], values[1::2]
+
+
+def _starts(groups):
+    """Find the start of each run in a sorted array."""
+    return np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+
+
+class Rescorer:
+    """Recompute kraken2 classifications at confidence thresholds."""
+
+    def __init__(self, taxonomy):
+        """Init function.
+
+        :param taxonomy: a `pykraken2.taxonomy.Taxonomy`, or path to a
+            kraken2 database directory or its `taxo.k2d` file.
+        """
+        if not isinstance(taxonomy, Taxonomy):
+            taxonomy = Taxonomy(taxonomy)
+        parents = np.array(taxonomy.parents, dtype=np.int64)
+        parents[0] = 0
+        n_nodes = len(parents)
+        depths = np.zeros(n_nodes, dtype=np.int64)
+        index = ancestors = np.arange(n_nodes)
+        while len(index):
+            live = ancestors > 0
+            index, ancestors = index[live], ancestors[live]
+            depths[index] += 1
+            ancestors = parents[ancestors]
+
+        # number taxa in depth-first order, such that the descendants of
+        # a taxon are those numbered from it up to the end of its subtree.
+        # Levels hold taxa in kraken2 order, with siblings adjacent.
+        by_depth = np.argsort(depths, kind='stable')
+        levels = np.split(by_depth, _starts(depths[by_depth])[1:])
+        sizes = np.ones(n_nodes, dtype=np.int64)
+        for level in reversed(levels[2:]):
+            sizes += np.bincount(
+                parents[level], weights=sizes[level],
+                minlength=n_nodes).astype(np.int64)
+        numbers = np.zeros(n_nodes, dtype=np.int64)
+        for level in levels[1:]:
+            siblings = _starts(parents[level])
+            before = np.cumsum(sizes[level]) - sizes[level]
+            before -= np.repeat(
+                before[siblings], np.diff(np.r_[siblings, len(level)]))
+            numbers[level] = numbers[parents[level]] + 1 + before
+
+        # arrays indexed by taxon number, 0 being no taxon
+        order = np.argsort(numbers)
+        self.parents = numbers[parents[order]]
+        self.external_ids = np.array(
+            taxonomy.external_ids, dtype=np.int64)[order]
+        self.depths = depths[order]
+        self.ends = np.arange(n_nodes) + sizes[order]
+        order = np.argsort(self.external_ids[1:])
+        self._sorted_external = self.external_ids[1:][order]
+        self._sorted_numbers = order + 1
+
+    def _internal(self, taxids):
+        """Convert external taxon IDs to taxon numbers."""
+        pos = np.searchsorted(self._sorted_external, taxids)
+        pos = np.minimum(pos, len(self._sorted_external) - 1)
+        found = self._sorted_external[pos] == taxids
+        if not found.all():
+            raise ValueError(
+                f"Taxa not in taxonomy: {np.unique(taxids[~found])}.")
+        return self._sorted_numbers[pos]
+
+    def _lift(self, nodes, depths):
+        """Move nodes up the taxonomy to given depths."""
+        nodes = nodes.copy()
+        index = np.flatnonzero(self.depths[nodes] > depths)
+        while len(index):
+            nodes[index] = self.parents[nodes[index]]
+            index = index[self.depths[nodes[index]] > depths[index]]
+        return nodes
+
+    def _lca(self, a, b):
+        """Lowest common ancestors of pairs of nodes."""
+        depths = np.minimum(self.depths[a], self.depths[b])
+        a, b = self._lift(a, depths), self._lift(b, depths)
+        index = np.flatnonzero(a != b)
+        while len(index):
+            a[index] = self.parents[a[index]]
+            b[index] = self.parents[b[index]]
+            index = index[a[index] != b[index]]
+        return a
+
+    def _group_lca(self, nodes, starts):
+        """Lowest common ancestor of each group of nodes.
+
+        :param nodes: nodes, ordered by group.
+        :param starts: index of the first node of each group.
+        """
+        sizes = np.diff(np.r_[starts, len(nodes)])
+        depths = np.repeat(
+            np.minimum.reduceat(self.depths[nodes], starts), sizes)
+        nodes = self._lift(nodes, depths)
+        while True:
+            low = np.minimum.reduceat(nodes, starts)
+            high = np.maximum.reduceat(nodes, starts)
+            differ = np.repeat(low != high, sizes)
+            if not differ.any():
+                return low
+            nodes[differ] = self.parents[nodes[differ]]
+
+    def rescore(self, offsets, taxids, counts, thresholds):
+        """Classify reads from their k-mer hits.
+
+        :param offsets: array of length one more than the number of reads,
+            the hits of read `i` are at `offsets[i]:offsets[i + 1]`.
+        :param taxids: taxon of each hit, see `kmer_arrays`.
+        :param counts: number of k-mers of each hit.
+        :param thresholds: confidence threshold, or sequence of these,
+            between 0 and 1.
+
+        :returns: array of the taxon assigned to each read, 0 for those
+            unclassified. For a sequence of thresholds the array has a
+            row for each threshold.
+        :raises ValueError: for thresholds outside [0, 1], or hits to taxa
+            not in the taxonomy.
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        taxids = np.asarray(taxids, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        scalar = np.ndim(thresholds) == 0
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+        if ((thresholds < 0) | (thresholds > 1)).any():
+            raise ValueError("Thresholds must be between 0 and 1.")
+        n_reads = len(offsets) - 1
+        calls = np.zeros((len(thresholds), n_reads), dtype=np.int64)
+
+        reads = np.repeat(np.arange(n_reads), np.diff(offsets))
+        # all k-mers count towards the total, the separator has no count
+        totals = np.bincount(reads, weights=counts, minlength=n_reads)
+        hits = taxids > 0
+        if not hits.any():
+            return calls[0] if scalar else calls
+
+        # combine hits of each taxon within a read; keys are ordered by
+        # read then taxon, so too are the resulting hits
+        n_nodes = len(self.parents)
+        keys = reads[hits] * n_nodes + self._internal(taxids[hits])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(
+            inverse.ravel(), weights=counts[hits]).astype(np.int64)
+        reads, nodes = keys // n_nodes, keys % n_nodes
+
+        # score each taxon by the hits on its path to the root: those
+        # preceding it, less those whose subtree ends before it
+        ends = reads * n_nodes + self.ends[nodes]
+        order = np.argsort(ends)
+        closed = np.r_[0, np.cumsum(counts[order])][
+            np.searchsorted(ends[order], keys, side='right')]
+        scores = np.cumsum(counts) - closed
+
+        # best taxon of each read, the LCA of those tied
+        starts = _starts(reads)
+        sizes = np.diff(np.r_[starts, len(reads)])
+        best = scores == np.repeat(np.maximum.reduceat(scores, starts), sizes)
+        best_calls = self._group_lca(nodes[best], _starts(reads[best]))
+        classified = reads[starts]
+
+        # the clade of an ancestor of the best taxon holds the hits whose
+        # LCA with the best taxon is at least as deep
+        depths = self.depths[self._lca(nodes, np.repeat(best_calls, sizes))]
+        order = np.lexsort((-depths, reads))
+        depths, cumulative = depths[order], np.cumsum(counts[order])
+        base = np.r_[0, cumulative][starts]
+        stops = starts + sizes
+
+        for i, threshold in enumerate(thresholds):
+            required = np.ceil(threshold * totals[classified])
+            pos = np.searchsorted(cumulative, base + required)
+            called = (pos < stops) | (required == 0)
+            target = np.where(
+                required == 0, self.depths[best_calls],
+                depths[np.minimum(pos, len(depths) - 1)])
+            result = self._lift(best_calls, target)
+            calls[i, classified] = np.where(
+                called, self.external_ids[result], 0)
+        return calls[0] if scalar else calls
+
+    def rescore_lines(self, lines, thresholds):
+        """Classify reads from lines of kraken2 output.
+
+        :param lines: sequence of lines of kraken2 output.
+        :param thresholds: confidence threshold or sequence of these.
+
+        :returns: tuple of read IDs and their taxa, see `rescore`.
+        """
+        read_ids = [line.split('\t', 2)[1] for line in lines]
+        return read_ids, self.rescore(*kmer_arrays(lines), thresholds)
+
+    def rescore_chunks(self, chunks, thresholds, batch_size=100000):
+        """Classify reads from streamed kraken2 output.
+
+        :param chunks: iterable of chunks of kraken2 output, as returned
+            by `Client.classify`. Lines may be split across chunks.
+        :param thresholds: confidence threshold or sequence of these.
+        :param batch_size: number of reads classified together. Chunks
+            from the server hold few reads, which are accumulated such
+            that the cost of each call into numpy is shared by many.
+
+        :returns: a generator of the results of `rescore_lines` for
+            batches of up to `batch_size` reads.
+        """
+        batch = []
+        for lines in split_lines(chunks):
+            batch.extend(lines)
+            while len(batch) >= batch_size:
+                yield self.rescore_lines(batch[:batch_size], thresholds)
+                del batch[:batch_size]
+        if batch:
+            yield self.rescore_lines(batch, thresholds)
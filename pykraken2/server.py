@@ -9,7 +9,10 @@ import uuid
 import zmq
 
 import pykraken2
-from pykraken2 import _log_level, packb, Signals, unpackb, ZMQ_MSG_SIZE
+from pykraken2 import (
+    _log_level, pack_header, packb, Signals, unpack_header, ZMQ_MSG_SIZE)
+from pykraken2.filters import ResultFilter
+from pykraken2.taxonomy import Taxonomy
 
 
 class Server:
@@ -27,16 +30,34 @@ class Server:
         Reads results from the kraken2 subprocess stdout and sends them back
         to the client.
 
+    Data batches and result messages are numbered such that a client may
+    reconnect with its token and resume a transaction. Results are resent
+    until acknowledged. If a client sends no data or keepalive for
+    `timeout` seconds, or does not acknowledge a result message for as
+    long, its token is reclaimed: the remainder of its sample is discarded
+    and the server is released for the next client.
+
+    Only recv_thread writes to kraken2, and never whilst holding
+    `transaction_lock`: a write blocks once kraken2's input pipe is full,
+    until send_thread reads its output.
     """
 
     FAKE_SEQUENCE_LENGTH = 50
     K2_BATCH_SIZE = 20  # number of seqs processed together in kraken2
     START_SENTINEL_NAME = 'START'
     END_SENTINEL_NAME = 'END'
+    POLL_TIMEOUT = 5  # seconds to wait for a client to acknowledge results
+    # requests, with the least and most frames following their header
+    REQUESTS = {
+        Signals.GET_TOKEN: (1, 2),
+        Signals.RUN_BATCH: (2, 2),
+        Signals.FINISH_TRANSACTION: (1, 1),
+        Signals.KEEPALIVE: (1, 1)}
 
     def __init__(
             self, kraken_db_dir, address='localhost', port=5555,
-            k2_binary='kraken2', threads=1):
+            k2_binary='kraken2', threads=1, k2_batch_size=K2_BATCH_SIZE,
+            msg_size=ZMQ_MSG_SIZE, timeout=600):
         """
         Server constructor.
 
@@ -46,6 +67,12 @@ class Server:
         :param port: port for initial connection
         :param k2_binary: path to kraken2 binary
         :param threads: number of threads for kraken2
+        :param k2_batch_size: number of sequences processed together
+            by kraken2. Larger batches reduce kraken2 overhead for short
+            reads at the expense of latency.
+        :param msg_size: size in bytes of result messages sent to clients
+        :param timeout: seconds of client inactivity after which its token
+            is reclaimed.
         """
         self.logger = pykraken2.get_named_logger('Server')
         self.logger.debug(f'k2 binary: {k2_binary}')
@@ -54,6 +81,9 @@ class Server:
 
         self.k2_binary = k2_binary
         self.threads = threads
+        self.k2_batch_size = k2_batch_size
+        self.msg_size = msg_size
+        self.timeout = timeout
         self.address = address
         self.recv_port = port
         self.send_port = None
@@ -62,9 +92,19 @@ class Server:
         self.k2proc = None
         self.token = None
         self.client_lock = Lock()
+        self.taxonomy = None  # loaded when first required by a filter
+
+        # state of the current transaction, shared with the send thread
+        # and modified under transaction_lock
+        self.transaction_lock = Lock()
+        self.batch_seq = -1  # last batch written to kraken2
+        self.records = 0  # number of records written to kraken2
+        self.result_seq = -1  # last result message sent
+        self.finished = False  # end sentinel has been written
+        self.abandoned = False  # token reclaimed, results are discarded
+        self.last_activity = time.monotonic()
+        self.result_filter = None  # ResultFilter requested by the client
 
-        # Have all seqs from current sample been passed to kraken
-        self.all_seqs_submitted_event = threading.Event()
         # Are we waiting for processing of a sample to start
         self.start_sample_event = threading.Event()
         self.start_sample_event.set()
@@ -79,7 +119,7 @@ class Server:
 
         self.flush_seqs = "".join([
             self.fake_sequence.format(f"DUMMY_{x}")
-            for x in range(self.K2_BATCH_SIZE)])
+            for x in range(self.k2_batch_size)])
 
     def __enter__(self):
         """Enter context manager."""
@@ -109,7 +149,7 @@ class Server:
             self.k2_binary,
             '--db', self.kraken_db_dir,
             '--threads', str(self.threads),
-            '--batch-size', str(self.K2_BATCH_SIZE),
+            '--batch-size', str(self.k2_batch_size),
             '/dev/fd/0']
 
         self.send_port = pykraken2.free_ports(1, lowest=self.recv_port+1)[0]
@@ -133,8 +173,7 @@ class Server:
         sentinels.
         """
         self.logger.info("Starting send results thread.")
-        socket = self.context.socket(zmq.REQ)
-        socket.connect(f"tcp://{self.address}:{self.send_port}")
+        socket = self._results_socket()
 
         while not self.terminate_event.is_set():
             if self.client_lock.locked():  # Is a client connected?
@@ -146,42 +185,90 @@ class Server:
                             self.start_sample_event.clear()
                             break
 
-                if self.all_seqs_submitted_event.is_set():
-                    # get remaining kraken2 output checking for end sentinel
-                    # TODO: reevaluate full line-by-line processing
-                    self.logger.info('Checking for sentinel')
-                    final_lines = []
-                    while True:
-                        line = self.k2proc.stdout.readline()
-                        if line.startswith(f'U\t{self.END_SENTINEL_NAME}'):
-                            self.logger.debug('Found termination sentinel')
-                            final_bit = "".join(final_lines).encode('UTF-8')
-                            socket.send_multipart(
-                                [packb(Signals.TRANSACTION_COMPLETE),
-                                 self.token, final_bit])
-                            socket.recv()
-                            break
-                        else:
-                            final_lines.append(line)
+                # read whole lines so as to always catch the end sentinel,
+                # a fixed size read may consume it or block beyond it.
+                lines, size, complete = [], 0, False
+                result_filter = self.result_filter
+                while size < self.msg_size:
+                    line = self.k2proc.stdout.readline()
+                    if line.startswith(f'U\t{self.END_SENTINEL_NAME}'):
+                        self.logger.debug('Found termination sentinel')
+                        complete = True
+                        break
+                    if result_filter is not None:
+                        line = result_filter.apply(line)
+                        if line is None:
+                            continue
+                    lines.append(line)
+                    size += len(line)
+                # a message is sent only once filled, or to end the sample
+                if not self.abandoned and (lines or complete):
+                    signal = Signals.TRANSACTION_COMPLETE if complete \
+                        else Signals.TRANSACTION_NOT_DONE
+                    self.result_seq += 1
+                    payload = "".join(lines).encode('UTF-8')
+                    socket = self._deliver(socket, [
+                        pack_header(signal, self.result_seq, len(payload)),
+                        self.token, payload])
+                if complete:
                     # TODO: is this the best place to be releasing?
                     self.logger.info('Releasing lock.')
-                    self.client_lock.release()
-                    continue
-
-                # TODO: there's a possible race condition here where we may
-                #       gobble up the end sentinel unintentionally. See
-                #       finish_transaction
-                stdout = self.k2proc.stdout.read(ZMQ_MSG_SIZE).encode('UTF-8')
-                socket.send_multipart([
-                    packb(Signals.TRANSACTION_NOT_DONE),
-                    self.token, stdout])
-                socket.recv()
+                    with self.transaction_lock:
+                        self.token = None
+                        self.client_lock.release()
             else:  # no client connected
                 self.logger.info('Waiting for client.')
                 time.sleep(1)
-        socket.close()
+        socket.close(linger=0)
         self.logger.info('Send results thread finished.')
 
+    def _results_socket(self):
+        """Create a socket for sending results to clients."""
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(f"tcp://{self.address}:{self.send_port}")
+        return socket
+
+    def _deliver(self, socket, msg):
+        """Send a result message, resending until it is acknowledged.
+
+        :param socket: socket on which to send.
+        :param msg: message frames.
+
+        :returns: the socket to use for subsequent messages.
+
+        Gives up if the client's token is reclaimed. Keepalives do not
+        count as activity here, a client must acknowledge results.
+        """
+        start = time.monotonic()
+        while not self.terminate_event.is_set() and not self.abandoned:
+            socket.send_multipart(msg, copy=False)
+            if socket.poll(timeout=1000 * self.POLL_TIMEOUT):
+                socket.recv()
+                self.last_activity = time.monotonic()
+                break
+            # a REQ socket cannot resend, so start afresh
+            self.logger.debug('Client did not acknowledge results.')
+            socket.close(linger=0)
+            socket = self._results_socket()
+            if time.monotonic() - start > self.timeout:
+                self.reclaim()
+        return socket
+
+    def reclaim(self):
+        """Reclaim the token of an unresponsive client.
+
+        The client's remaining results are discarded. Its data is ended in
+        the kraken2 input stream by the receive thread, if the client has
+        not already done so.
+        """
+        with self.transaction_lock:
+            if self.token is None or self.abandoned:
+                return
+            self.logger.warning(
+                f'No activity from client for {self.timeout}s, '
+                'reclaiming token.')
+            self.abandoned = True
+
     def recv(self):
         """Receive signals from client.
 
@@ -203,81 +290,187 @@ class Server:
 
         while not self.terminate_event.is_set():
             if poller.poll(timeout=1000):
-                query = socket.recv_multipart()
-                route = Signals(unpackb(query[0])).name.lower()
-                msg = getattr(self, route)(*query[1:])
-                socket.send_multipart(msg)
+                socket.send_multipart(
+                    self._route(socket.recv_multipart(copy=False)))
+            # a client that has stopped sending data is reclaimed here,
+            # one that has stopped receiving results in send_results
+            if self.token is not None and not self.finished:
+                if time.monotonic() - self.last_activity > self.timeout:
+                    self.reclaim()
+                if self.abandoned:
+                    self._end_sample()
         socket.close()
         self.logger.info("API router thread finished.")
 
-    def get_token(self):
+    def _route(self, frames):
+        """Forward a request to the method handling it.
+
+        :param frames: message frames, a header followed by the token and
+            payload, if any, as `zmq.Frame`. Only the payload of a batch is
+            large, the token is copied and the payload passed on as is.
+
+        :returns: reply frames.
+        """
+        try:
+            header = unpack_header(frames[0].bytes)
+            if header.signal not in self.REQUESTS:
+                raise ValueError(f"Unexpected signal: {header.signal}.")
+            least, most = self.REQUESTS[header.signal]
+            if not least <= len(frames) - 1 <= most:
+                raise ValueError(
+                    f"{header.signal.name} has {len(frames) - 1} frames.")
+        except ValueError as e:
+            self.logger.error(f'Received invalid request: {e}')
+            return [pack_header(Signals.INVALID_REQUEST)]
+        args = [frames[1].bytes] + frames[2:]
+        return getattr(self, header.signal.name.lower())(header, *args)
+
+    def get_token(self, header, token, result_filter=None):
         """Set a token that client and server share.
 
-        :returns: (Signals.OK_TO_BEGIN, token, port) if no client
-            is already connected or (Signals.WAIT_FOR_TOKEN, None, None)
-            if a client should wait.
+        :param header: request header.
+        :param token: token of a transaction to resume, empty to begin a
+            new transaction.
+        :param result_filter: a packed `ResultFilter` applied to the
+            results of a new transaction. A resumed transaction keeps its
+            filter.
+
+        :returns: (OK_TO_BEGIN header, token, port, records) if no client
+            is already connected, or `token` is that of the current
+            transaction. The header sequence number is that of the last
+            data batch received and `records` the number of records
+            received; a new transaction has -1 and 0. Otherwise
+            (WAIT_FOR_TOKEN header,) if a client should wait, or
+            (INVALID_REQUEST header,) if the filter is invalid.
         """
-        if not self.client_lock.locked():
+        with self.transaction_lock:
+            if token and token == self.token \
+                    and not self.abandoned:
+                self.last_activity = time.monotonic()
+                self.logger.info(
+                    f'Resuming transaction after batch {self.batch_seq}.')
+                return self._begin()
+            if self.client_lock.locked():
+                return [pack_header(Signals.WAIT_FOR_TOKEN)]
+            # the filter is prepared only once the client may begin, not
+            # for each poll of a waiting client
+            if result_filter is not None:
+                try:
+                    result_filter = self._result_filter(result_filter.bytes)
+                except (ValueError, KeyError, OSError) as e:
+                    self.logger.error(f'Cannot apply result filter: {e}')
+                    return [pack_header(Signals.INVALID_REQUEST)]
+            # set first, such that results are read only after the start
+            self.start_sample_event.set()
             self.client_lock.acquire()
             self.token = str(uuid.uuid4()).encode('UTF-8')
-            self.k2proc.stdin.write(
-                self.fake_sequence.format(self.START_SENTINEL_NAME))
-            self.start_sample_event.set()
-            self.all_seqs_submitted_event.clear()
-            self.logger.info("Got lock")
-            reply = [
-                packb(Signals.OK_TO_BEGIN), self.token,
-                packb(self.send_port)]
-        else:
-            reply = [
-                packb(Signals.WAIT_FOR_TOKEN),
-                packb(None), packb(None)]
-        return reply
-
-    def run_batch(self, token, data):
+            self.batch_seq = -1
+            self.records = 0
+            self.result_seq = -1
+            self.finished = False
+            self.abandoned = False
+            self.last_activity = time.monotonic()
+            self.result_filter = result_filter
+        self.k2proc.stdin.write(
+            self.fake_sequence.format(self.START_SENTINEL_NAME))
+        self.logger.info("Got lock")
+        return self._begin()
+
+    def _result_filter(self, data):
+        """Unpack a result filter, loading the taxonomy if it is needed."""
+        result_filter = ResultFilter.unpack(data)
+        if result_filter.needs_taxonomy:
+            if self.taxonomy is None:
+                self.logger.info('Loading taxonomy.')
+                self.taxonomy = Taxonomy(self.kraken_db_dir)
+            result_filter.bind(self.taxonomy)
+        return result_filter
+
+    def _begin(self):
+        """Reply to a client allowed to begin, or resume, a transaction."""
+        return [
+            pack_header(Signals.OK_TO_BEGIN, self.batch_seq), self.token,
+            packb(self.send_port), packb(self.records)]
+
+    def _valid(self, token):
+        """Check a token is that of the current, live, transaction."""
+        return token == self.token and not self.abandoned
+
+    def run_batch(self, header, token, data):
         """Process a data chunk.
 
-        :param data: a chunk of sequence data.
+        :param header: request header, holding the sequence number of the
+            chunk, its length and the number of records it holds, as
+            counted by the client. A chunk that has already been received
+            is acknowledged but not processed.
         :param token: client-server validation token.
+        :param data: a chunk of sequence data, as a `zmq.Frame`.
         """
-        if token != self.token:
-            self.logger.error('run_batch received incorrect token.')
-            msg = [None, None]
-        else:
-            self.k2proc.stdin.write(data.decode('UTF-8'))
+        seq = header.seq
+        with self.transaction_lock:
+            if not self._valid(token) or self.finished \
+                    or seq > self.batch_seq + 1 \
+                    or header.length != len(data):
+                self.logger.error('run_batch received invalid request.')
+                return [pack_header(Signals.INVALID_TOKEN)]
+            self.last_activity = time.monotonic()
+        if seq == self.batch_seq + 1:
+            # write the frame's buffer directly, bypassing the text
+            # layer; anything it holds must be written first.
             self.k2proc.stdin.flush()
-            msg = [packb('Server: Chunk received'), packb(None)]
-        return msg
+            self.k2proc.stdin.buffer.write(data.buffer)
+            self.k2proc.stdin.buffer.flush()
+            self.batch_seq = seq
+            self.records += header.count
+        else:
+            self.logger.debug(f'Ignoring repeated batch {seq}.')
+        return [pack_header(Signals.BATCH_RECEIVED, self.batch_seq)]
+
+    def keepalive(self, header, token):
+        """Keep the transaction of a client waiting on its source.
+
+        :param header: request header.
+        :param token: client-server validation token.
+        """
+        with self.transaction_lock:
+            if not self._valid(token):
+                return [pack_header(Signals.INVALID_TOKEN)]
+            self.last_activity = time.monotonic()
+        return [pack_header(Signals.KEEPALIVE_RECEIVED)]
 
-    def finish_transaction(self, token):
+    def finish_transaction(self, header, token):
         """All data has been sent from a client.
 
         Insert STOP sentinel into kraken2 stdin.
         Flush the buffer with some dummy seqs.
         """
-        if token != self.token:
-            self.logger.error(
-                'finish transaction received incorrect token.')
-            msg = [None, None]
-        else:
-            # TODO: see note on race condition in send_results. We
-            #       need to wait here until that thread is ready to
-            #       catch the end sentinel.
-            self.all_seqs_submitted_event.set()
-            self.k2proc.stdin.write(
-                self.fake_sequence.format(self.END_SENTINEL_NAME))
-            self.logger.info('flushing')
-            self.k2proc.stdin.write(self.flush_seqs)
-            self.logger.info("All dummy seqs written")
-            msg = [packb("Transaction finished"), packb(None)]
-        return msg
+        with self.transaction_lock:
+            if not self._valid(token):
+                self.logger.error(
+                    'finish transaction received incorrect token.')
+                return [pack_header(Signals.INVALID_TOKEN)]
+            self.last_activity = time.monotonic()
+        if not self.finished:
+            self._end_sample()
+        return [pack_header(Signals.TRANSACTION_FINISHED)]
+
+    def _end_sample(self):
+        """Write the end sentinel and flush sequences to kraken2."""
+        self.k2proc.stdin.write(
+            self.fake_sequence.format(self.END_SENTINEL_NAME))
+        self.logger.info('flushing')
+        self.k2proc.stdin.write(self.flush_seqs)
+        self.k2proc.stdin.flush()
+        self.logger.info("All dummy seqs written")
+        self.finished = True
 
 
 def main(args):
     """Entry point to run a kraken2 server."""
     with Server(
             args.database, args.address, args.port,
-            args.k2_binary, args.threads):
+            args.k2_binary, args.threads, args.batch_size, args.msg_size,
+            args.timeout):
         while True:
             pass
 
@@ -295,12 +488,23 @@ def argparser():
         "--address", default='localhost',
         help="location on which to listen for clients.")
     parser.add_argument(
-        '--port', default=5555,
+        '--port', default=5555, type=int,
         help="port on which to listen for clients.")
     parser.add_argument(
-        '--threads', default=8,
+        '--threads', default=8, type=int,
         help="kraken2 compute threads.")
     parser.add_argument(
         '--k2-binary', default='kraken2',
         help="location of kraken2 binary.")
+    parser.add_argument(
+        '--batch-size', default=Server.K2_BATCH_SIZE, type=int,
+        help="number of sequences processed together by kraken2.")
+    parser.add_argument(
+        '--msg-size', default=ZMQ_MSG_SIZE, type=int,
+        help="size in bytes of result messages sent to clients.")
+    parser.add_argument(
+        '--timeout', default=600, type=int,
+        help=(
+            "seconds of client inactivity after which its transaction is "
+            "abandoned."))
     return parser
@@ -0,0 +1,225 @@
+"""Input sources for pykraken2 clients.
+
+Sources are converted lazily into wire messages: chunks of FASTQ text
+of approximately a requested size. Messages always end on a record
+boundary, such that a client may stop sending at any message and leave
+the server's kraken2 input stream intact. FASTQ records are assumed to
+comprise four lines.
+"""
+
+import asyncio
+import inspect
+import io
+import os
+
+# kraken2 only masks bases with --minimum-base-quality, so the value used
+# for records without qualities is immaterial unless that option is set.
+DEFAULT_QUALITY = b'I'
+
+
+def _to_bytes(value):
+    """Convert str or bytes-like to bytes."""
+    if isinstance(value, str):
+        return value.encode('UTF-8')
+    return bytes(value)
+
+
+def format_record(record):
+    """Format a read record as FASTQ.
+
+    :param record: tuple of (id, sequence[, quality]), each element str
+        or bytes. Reads without quality are given a uniform quality.
+
+    :returns: bytes.
+    """
+    name, seq, *qual = record
+    seq = _to_bytes(seq)
+    if qual and qual[0] is not None:
+        qual = _to_bytes(qual[0])
+    else:
+        qual = DEFAULT_QUALITY * len(seq)
+    return b''.join((
+        b'@', _to_bytes(name), b'\n', seq, b'\n+\n', qual, b'\n'))
+
+
+def _item_bytes(item):
+    """Convert a record or chunk of FASTQ text to bytes."""
+    if isinstance(item, (tuple, list)):
+        return format_record(item)
+    return _to_bytes(item)
+
+
+def _record_end(buffer):
+    """Find the end of the last complete FASTQ record in a buffer.
+
+    :param buffer: FASTQ text starting at a record boundary.
+
+    :returns: the position after the last complete record, 0 if there
+        are no complete records.
+    """
+    pos = len(buffer)
+    for _ in range(buffer.count(b'\n') % 4 + 1):
+        pos = buffer.rfind(b'\n', 0, pos)
+        if pos == -1:
+            break
+    return pos + 1
+
+
+def _split(buffer, size):
+    """Remove messages from the front of a buffer whilst it is full.
+
+    Messages end at the last record boundary within `size` bytes. Where
+    a record is longer than `size`, the message ends at the last boundary
+    in the buffer.
+    """
+    while len(buffer) >= size:
+        end = _record_end(buffer[:size]) or _record_end(buffer)
+        if not end:
+            break
+        yield bytes(buffer[:end])
+        del buffer[:end]
+
+
+def _messages(pieces, size):
+    """Accumulate pieces of FASTQ text into messages.
+
+    :param pieces: an iterable of bytes.
+    :param size: an `AdaptiveSize`, its current value is used as the
+        target size of each message.
+    """
+    buffer = bytearray()
+    for data in pieces:
+        buffer += data
+        yield from _split(buffer, size.value)
+    if buffer:
+        if not buffer.endswith(b'\n'):
+            buffer += b'\n'
+        yield bytes(buffer)
+
+
+async def _amessages(pieces, size):
+    """Accumulate pieces of FASTQ text into messages.
+
+    :param pieces: an async iterable of bytes.
+    :param size: an `AdaptiveSize`, its current value is used as the
+        target size of each message.
+    """
+    buffer = bytearray()
+    async for data in pieces:
+        buffer += data
+        for message in _split(buffer, size.value):
+            yield message
+    if buffer:
+        if not buffer.endswith(b'\n'):
+            buffer += b'\n'
+        yield bytes(buffer)
+
+
+def _read(read, size):
+    """Read pieces from a `read(n)` function until it is exhausted."""
+    while True:
+        data = read(size.value)
+        if not data:
+            break
+        yield _to_bytes(data)
+
+
+def batches(source, size):
+    """Create wire messages from a source.
+
+    :param source: one of: a path to a FASTQ file; a file-like object
+        such as `sys.stdin.buffer`; a bytes-like buffer of FASTQ text; or
+        an iterable of records (see `format_record`) or chunks of FASTQ
+        text, as str or bytes.
+    :param size: an `AdaptiveSize`, its current value is used as the
+        target size of each message.
+
+    Sources are consumed only as messages are requested, so memory use
+    is bounded by the message size.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as fh:
+            yield from batches(fh, size)
+    elif hasattr(source, 'read'):
+        yield from _messages(_read(source.read, size), size)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        yield from batches(io.BytesIO(source), size)
+    elif hasattr(source, '__iter__'):
+        yield from _messages(map(_item_bytes, source), size)
+    else:
+        raise TypeError(
+            f"Unsupported source type: {type(source).__name__}.")
+
+
+def skip_records(messages, n):
+    """Skip the first `n` records of a sequence of messages.
+
+    :param messages: iterable of messages, as created by `batches`.
+    :param n: number of records to skip.
+
+    Used to resume a transaction: the server reports the number of
+    records it has received, which does not depend on message sizes.
+    """
+    for message in messages:
+        if n > 0:
+            lines = message.count(b'\n')
+            if lines <= 4 * n:
+                n -= lines // 4
+                continue
+            pos = -1
+            for _ in range(4 * n):
+                pos = message.index(b'\n', pos + 1)
+            message = message[pos + 1:]
+            n = 0
+        yield message
+
+
+async def _aread(read, size):
+    """Read pieces from a `read(n)` coroutine until it is exhausted."""
+    while True:
+        data = await read(size.value)
+        if not data:
+            break
+        yield _to_bytes(data)
+
+
+async def _aitems(source):
+    """Convert items of an async iterable to bytes."""
+    async for item in source:
+        yield _item_bytes(item)
+
+
+async def abatches(source, size):
+    """Asynchronously create wire messages from a source.
+
+    :param source: one of: a path to a FASTQ file; a file-like object
+        with a `read(n)` method, either a coroutine such as
+        `asyncio.StreamReader.read` or a blocking method such as that of
+        `sys.stdin.buffer`; or an async iterable of records (see
+        `format_record`) or chunks of FASTQ text, as str or bytes.
+    :param size: an `AdaptiveSize`, its current value is used as the
+        target size of each message.
+
+    Blocking reads are run in an executor so as to not block the event
+    loop.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as fh:
+            async for data in abatches(fh, size):
+                yield data
+    elif hasattr(source, 'read'):
+        if inspect.iscoroutinefunction(source.read):
+            read = source.read
+        else:
+            loop = asyncio.get_running_loop()
+
+            async def read(n):
+                return await loop.run_in_executor(None, source.read, n)
+        async for data in _amessages(_aread(read, size), size):
+            yield data
+    elif hasattr(source, '__aiter__'):
+        async for data in _amessages(_aitems(source), size):
+            yield data
+    else:
+        raise TypeError(
+            f"Unsupported source type: {type(source).__name__}.")
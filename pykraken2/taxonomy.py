@@ -0,0 +1,140 @@
+"""kraken2 database taxonomy.
+
+Reads the `taxo.k2d` file of a kraken2 database. kraken2 numbers taxa
+internally in breadth-first order, such that a parent always has a lower
+internal ID than its children and the children of a taxon are numbered
+consecutively. Taxa are exposed here by their external (NCBI) IDs, as
+reported in kraken2 output.
+"""
+
+import os
+import struct
+
+import pykraken2
+
+
+class Taxonomy:
+    """The taxonomy of a kraken2 database."""
+
+    MAGIC = b'K2TAXDAT'
+    # magic, then node count, name data length, rank data length
+    HEADER = struct.Struct('<8sQQQ')
+    # parent, first child, child count, name offset, rank offset,
+    # external ID, godparent; IDs other than external are internal
+    NODE = struct.Struct('<QQQQQQQ')
+
+    def __init__(self, path):
+        """Init function.
+
+        :param path: path to a kraken2 database directory or its
+            `taxo.k2d` file.
+
+        :raises ValueError: if the file is not a kraken2 taxonomy.
+        """
+        self.logger = pykraken2.get_named_logger('Taxonomy')
+        if os.path.isdir(path):
+            path = os.path.join(path, 'taxo.k2d')
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        if len(data) < self.HEADER.size:
+            raise ValueError(f"{path} is not a kraken2 taxonomy.")
+        magic, count, name_len, rank_len = self.HEADER.unpack_from(data)
+        size = self.HEADER.size + count * self.NODE.size + name_len + rank_len
+        if magic != self.MAGIC or len(data) != size:
+            raise ValueError(f"{path} is not a kraken2 taxonomy.")
+
+        nodes = self.NODE.size * count
+        (self.parents, self.first_children, self.child_counts,
+            self._name_offsets, self._rank_offsets, self.external_ids,
+            _) = (
+                list(x) for x in zip(*self.NODE.iter_unpack(
+                    data[self.HEADER.size:self.HEADER.size + nodes])))
+        names = self.HEADER.size + nodes
+        self._names = data[names:names + name_len]
+        self._ranks = data[names + name_len:]
+        # internal ID 0 is a placeholder for "no taxon"
+        self.internal_ids = {
+            taxid: i for i, taxid in enumerate(self.external_ids) if i}
+        self.logger.debug(f'Loaded {count} taxa from {path}.')
+
+    def __len__(self):
+        """Return the number of taxa, including the null taxon."""
+        return len(self.external_ids)
+
+    def __contains__(self, taxid):
+        """Check if the taxonomy contains a taxon."""
+        return taxid in self.internal_ids
+
+    def _internal(self, taxid):
+        try:
+            return self.internal_ids[taxid]
+        except KeyError:
+            raise KeyError(f"Taxon {taxid} is not in the taxonomy.") \
+                from None
+
+    @staticmethod
+    def _string(data, offset):
+        return data[offset:data.index(b'\0', offset)].decode('UTF-8')
+
+    def name(self, taxid):
+        """Return the scientific name of a taxon."""
+        return self._string(
+            self._names, self._name_offsets[self._internal(taxid)])
+
+    def rank(self, taxid):
+        """Return the rank of a taxon, e.g. 'species'."""
+        return self._string(
+            self._ranks, self._rank_offsets[self._internal(taxid)])
+
+    def parent(self, taxid):
+        """Return the parent of a taxon, 0 for the root."""
+        return self.external_ids[self.parents[self._internal(taxid)]]
+
+    def lineage(self, taxid):
+        """Return a taxon and its ancestors, ending with the root."""
+        node = self._internal(taxid)
+        lineage = []
+        while node:
+            lineage.append(self.external_ids[node])
+            node = self.parents[node]
+        return lineage
+
+    def is_ancestor(self, a, b):
+        """Check if taxon `a` is `b` or one of its ancestors."""
+        a, b = self._internal(a), self._internal(b)
+        while b > a:
+            b = self.parents[b]
+        return a == b
+
+    def lca(self, a, b):
+        """Return the lowest common ancestor of two taxa.
+
+        Following kraken2, the LCA of 0 and any taxon is that taxon.
+        """
+        if not a or not b:
+            return a or b
+        a, b = self._internal(a), self._internal(b)
+        while a != b:
+            if a > b:
+                a = self.parents[a]
+            else:
+                b = self.parents[b]
+        return self.external_ids[a]
+
+    def subtree(self, taxids):
+        """Return taxa and all of their descendants.
+
+        :param taxids: iterable of taxa.
+
+        :returns: a frozenset of taxa.
+        """
+        nodes = [self._internal(taxid) for taxid in taxids]
+        subtree = set()
+        while nodes:
+            node = nodes.pop()
+            if node in subtree:
+                continue
+            subtree.add(node)
+            first = self.first_children[node]
+            nodes.extend(range(first, first + self.child_counts[node]))
+        return frozenset(self.external_ids[node] for node in subtree)
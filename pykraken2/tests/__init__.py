@@ -0,0 +1 @@
+"""pykraken2 tests."""
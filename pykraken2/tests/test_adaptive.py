@@ -0,0 +1,39 @@
+"""Tests for adaptive message sizing."""
+import unittest
+
+from pykraken2 import AdaptiveSize
+
+
+class AdaptiveSizeTest(unittest.TestCase):
+    """Test class."""
+
+    def test_000_fixed(self):
+        """Size does not change when adaptation is disabled."""
+        size = AdaptiveSize(100, 10, 1000, adaptive=False, window=1)
+        for _ in range(10):
+            self.assertEqual(size.update(100, 1.0), 100)
+
+    def test_001_initial_clamped(self):
+        """Initial size is kept within bounds."""
+        self.assertEqual(AdaptiveSize(1, 10, 1000).value, 10)
+        self.assertEqual(AdaptiveSize(5000, 10, 1000).value, 1000)
+        with self.assertRaises(ValueError):
+            AdaptiveSize(10, 100, 10)
+
+    def test_002_grows_with_throughput(self):
+        """Size grows whilst larger messages give better throughput."""
+        size = AdaptiveSize(100, 10, 1000, window=1)
+        for _ in range(10):
+            # fixed per-message overhead, so larger is always better
+            size.update(size.value, 0.1 + size.value * 1e-6)
+        self.assertGreaterEqual(size.value, 500)
+        self.assertLessEqual(size.value, 1000)
+
+    def test_003_shrinks_on_degradation(self):
+        """Size reverses direction when throughput drops."""
+        size = AdaptiveSize(100, 10, 1000, window=1)
+        size.update(100, 1.0)
+        self.assertEqual(size.value, 200)
+        # throughput halves, step back down
+        size.update(200, 4.0)
+        self.assertEqual(size.value, 100)
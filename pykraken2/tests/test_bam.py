@@ -0,0 +1,140 @@
+"""Tests for BAM input."""
+import array
+from contextlib import ExitStack
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+from pykraken2 import free_ports
+from pykraken2.bam import BamReader, is_bam
+from pykraken2.client import Client
+from pykraken2.filters import ResultFilter
+from pykraken2.server import Server
+from pykraken2.tests.util import read_records
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+
+@unittest.skipIf(pysam is None, "pysam is not installed.")
+class BamTest(unittest.TestCase):
+    """Test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Write an unaligned BAM of test reads."""
+        data_dir = Path(__file__).parent / 'test_data'
+        cls.out_dir = tempfile.mkdtemp()
+        cls.database = data_dir / 'db'
+        cls.fastq = data_dir / 'reads2.fq'
+        cls.expected_output = data_dir / 'correct_output' / 'k2out2.tsv'
+        # BAM read names end at the first space of the FASTQ header
+        cls.records = [
+            (name.split()[0], seq, qual)
+            for name, seq, qual in read_records(cls.fastq)]
+        cls.bam = Path(cls.out_dir) / 'reads.bam'
+        header = {'HD': {'VN': '1.6'}, 'RG': [{'ID': 'rg1'}]}
+        with pysam.AlignmentFile(cls.bam, 'wb', header=header) as bam:
+            for i, (name, seq, qual) in enumerate(cls.records):
+                read = pysam.AlignedSegment(bam.header)
+                read.query_name = name
+                read.query_sequence = seq
+                read.query_qualities = pysam.qualitystring_to_array(qual)
+                read.flag = 4
+                read.set_tag('RG', 'rg1')
+                if i % 2:
+                    read.set_tag('BC', i)
+                bam.write(read)
+            # secondary records are not classified
+            read.flag = 4 | 256
+            bam.write(read)
+        cls.port = free_ports(1)[0]
+        cls.address = '127.0.0.1'
+        cls.k2_binary = 'kraken2'
+
+    @classmethod
+    def tearDownClass(cls):
+        """Remove temporary files on test completion."""
+        shutil.rmtree(cls.out_dir)
+
+    def test_000_is_bam(self):
+        """BAM and SAM paths are recognised."""
+        self.assertTrue(is_bam(self.bam))
+        self.assertTrue(is_bam('reads.SAM'))
+        self.assertFalse(is_bam(self.fastq))
+        self.assertFalse(is_bam([]))
+
+    def test_001_read(self):
+        """Records are read from a BAM."""
+        reader = BamReader(self.bam, threads=2)
+        reader.CHUNK_SIZE = 3
+        self.assertEqual(list(reader), self.records)
+
+    def test_002_annotate(self):
+        """Tags are appended to results."""
+        reader = BamReader(self.bam, tags=['RG', 'BC'])
+        list(reader)
+        name1, name2 = self.records[0][0], self.records[1][0]
+        chunks = [f'C\t{name1}\t1\t10\t0:1\nC\t{name2}', '\t2\t10\t0:1\n']
+        self.assertEqual(
+            ''.join(reader.annotate(chunks)),
+            f'C\t{name1}\t1\t10\t0:1\tRG:Z:rg1\n'
+            f'C\t{name2}\t2\t10\t0:1\tRG:Z:rg1\tBC:i:1\n')
+        self.assertEqual(len(reader.read_tags), len(self.records) - 2)
+
+    def test_003_missing_file(self):
+        """Errors reading are raised in the consumer."""
+        with self.assertRaises(Exception):
+            list(BamReader(Path(self.out_dir) / 'missing.bam'))
+
+    def test_004_empty_and_array(self):
+        """Records without sequence are skipped, arrays are SAM text."""
+        bam = Path(self.out_dir) / 'arrays.bam'
+        header = {'HD': {'VN': '1.6'}}
+        with pysam.AlignmentFile(bam, 'wb', header=header) as out:
+            for name, seq in (('empty', None), ('read', 'ACGT')):
+                read = pysam.AlignedSegment(out.header)
+                read.query_name = name
+                read.flag = 4
+                if seq is not None:
+                    read.query_sequence = seq
+                    read.query_qualities = \
+                        pysam.qualitystring_to_array('IIII')
+                read.set_tag('ML', array.array('B', [1, 255]))
+                read.set_tag('XF', array.array('f', [1.5]))
+                out.write(read)
+        reader = BamReader(bam, tags=['ML', 'XF'])
+        self.assertEqual(list(reader), [('read', 'ACGT', 'IIII')])
+        self.assertEqual(
+            reader.read_tags, {'read': 'ML:B:C,1,255\tXF:B:f,1.5'})
+
+    def test_005_tags_filtered(self):
+        """Tags are not appended to results from which reads are removed."""
+        client = Client(self.address, self.port)
+        for result_filter in (
+                ResultFilter(classified_only=True),
+                ResultFilter(columns=['read_id', 'taxid'])):
+            with self.assertRaises(ValueError):
+                next(client.classify(
+                    BamReader(self.bam, tags=['RG']), result_filter))
+
+    def test_010_classify(self):
+        """Classify a BAM, carrying tags through to results."""
+        with ExitStack() as stack:
+            stack.enter_context(
+                Server(
+                    self.database, self.address, self.port,
+                    self.k2_binary))
+            client = stack.enter_context(Client(self.address, self.port))
+            result = ''.join(client.classify(self.bam))
+            tagged = ''.join(
+                client.classify(BamReader(self.bam, tags=['RG'])))
+
+        with open(self.expected_output, 'r') as fh:
+            expected = fh.read()
+        self.assertEqual(expected, result)
+        self.assertEqual(
+            expected.replace('\n', '\tRG:Z:rg1\n'), tagged)
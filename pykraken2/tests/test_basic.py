@@ -1,15 +1,58 @@
 """pykraken2 tests."""
+import asyncio
 from contextlib import ExitStack
 from pathlib import Path
 import shutil
 import subprocess as sub
 import tempfile
 from threading import Thread
+import time
 import unittest
 
-from pykraken2 import free_ports
-from pykraken2.client import Client
-from pykraken2.server import Server
+import zmq
+
+from pykraken2 import (
+    AdaptiveSize, free_ports, pack_header, packb, Signals, unpack_header)
+from pykraken2.client import (
+    argparser as client_argparser, AsyncClient, Client, main as client_main)
+from pykraken2.filters import ResultFilter
+from pykraken2.output import read_binary
+from pykraken2.server import argparser as server_argparser, Server
+from pykraken2.sources import batches
+from pykraken2.tests.util import read_records
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class RecordingServer(Server):
+    """Server recording the size of data messages received."""
+
+    def __init__(self, *args, **kwargs):
+        """Init function."""
+        super().__init__(*args, **kwargs)
+        self.msg_sizes = []
+
+    def run_batch(self, header, token, data):
+        """Record message size and process data."""
+        self.msg_sizes.append(len(data))
+        return super().run_batch(header, token, data)
+
+
+class FilterCountingServer(Server):
+    """Server counting the result filters prepared."""
+
+    def __init__(self, *args, **kwargs):
+        """Init function."""
+        super().__init__(*args, **kwargs)
+        self.filters = 0
+
+    def _result_filter(self, data):
+        """Count and prepare a filter."""
+        self.filters += 1
+        return super()._result_filter(data)
 
 
 class SimpleTest(unittest.TestCase):
@@ -129,6 +172,211 @@ class SimpleTest(unittest.TestCase):
         client_str = ''.join(result)
         self.assertEqual(expected_str, client_str)
 
+    def test_012_fixed_msg_size(self):
+        """Client sends messages of the requested size."""
+        with ExitStack() as stack:
+            server = stack.enter_context(
+                RecordingServer(
+                    self.database, self.address, self.port,
+                    self.k2_binary, self.threads))
+            client = stack.enter_context(
+                Client(
+                    self.address, self.port, msg_size=10000, adaptive=False))
+            result = ''.join(client.process_fastq(self.fastq1))
+
+        # messages are cut at a record boundary within the size
+        self.assertGreater(len(server.msg_sizes), 1)
+        self.assertLessEqual(max(server.msg_sizes), 10000)
+        self.assertGreater(min(server.msg_sizes[:-1]), 5000)
+        with open(self.expected_output1, 'r') as fh:
+            self.assertEqual(fh.read(), result)
+
+    def test_013_server_options(self):
+        """Server batch and message size options are used."""
+        args = server_argparser().parse_args([
+            str(self.database), '--port', str(self.port),
+            '--address', self.address, '--k2-binary', self.k2_binary,
+            '--batch-size', '5', '--msg-size', '500'])
+        with ExitStack() as stack:
+            server = stack.enter_context(
+                Server(
+                    args.database, args.address, args.port,
+                    args.k2_binary, args.threads, args.batch_size,
+                    args.msg_size))
+            client = stack.enter_context(
+                Client(self.address, self.port))
+            chunks = list(client.process_fastq(self.fastq1))
+
+        cmd = server.k2proc.args
+        self.assertEqual(cmd[cmd.index('--batch-size') + 1], '5')
+        self.assertEqual(server.flush_seqs.count('@DUMMY_'), 5)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks[:-1]:
+            # whole lines are sent once the size is reached
+            self.assertGreaterEqual(len(chunk), 500)
+            self.assertTrue(chunk.endswith('\n'))
+            self.assertLess(len(chunk) - len(chunk.splitlines(True)[-1]), 500)
+        with open(self.expected_output1, 'r') as fh:
+            self.assertEqual(fh.read(), ''.join(chunks))
+
+    def test_014_classify_records(self):
+        """Classify an iterable of records."""
+        records = iter(read_records(self.fastq1))
+        with ExitStack() as stack:
+            stack.enter_context(
+                Server(
+                    self.database, self.address, self.port,
+                    self.k2_binary, self.threads))
+            client = stack.enter_context(
+                Client(self.address, self.port))
+            result = ''.join(client.classify(records))
+
+        with open(self.expected_output1, 'r') as fh:
+            self.assertEqual(fh.read(), result)
+
+    def test_015_invalid_request(self):
+        """Malformed requests are rejected without stopping the server."""
+        with ExitStack() as stack:
+            stack.enter_context(
+                Server(
+                    self.database, self.address, self.port,
+                    self.k2_binary, self.threads))
+            socket = zmq.Context.instance().socket(zmq.REQ)
+            stack.callback(socket.close, linger=0)
+            socket.connect(f'tcp://{self.address}:{self.port}')
+            for query in (
+                    [packb(1)],
+                    [b'\x02' + pack_header(Signals.GET_TOKEN)[1:]],
+                    [pack_header(Signals.OK_TO_BEGIN)],
+                    [pack_header(Signals.GET_TOKEN)],
+                    [pack_header(Signals.RUN_BATCH, 0, 0), b'token'],
+                    [pack_header(Signals.FINISH_TRANSACTION)],
+                    [pack_header(Signals.FINISH_TRANSACTION), b'token', b''],
+                    [pack_header(Signals.KEEPALIVE)]):
+                socket.send_multipart(query)
+                header, = socket.recv_multipart()
+                self.assertEqual(
+                    unpack_header(header).signal, Signals.INVALID_REQUEST)
+            client = stack.enter_context(Client(self.address, self.port))
+            result = ''.join(client.process_fastq(self.fastq1))
+
+        with open(self.expected_output1, 'r') as fh:
+            self.assertEqual(fh.read(), result)
+
+    def test_016_result_filter(self):
+        """Results are filtered and projected by the server."""
+        with open(self.expected_output1, 'r') as fh:
+            expected = [
+                line.split('\t') for line in fh if line.startswith('C')]
+        with ExitStack() as stack:
+            server = stack.enter_context(
+                Server(
+                    self.database, self.address, self.port,
+                    self.k2_binary, self.threads))
+            client = stack.enter_context(Client(self.address, self.port))
+            result = ''.join(client.classify(
+                self.fastq1, ResultFilter(
+                    classified_only=True, columns=['read_id', 'taxid'])))
+            self.assertEqual(
+                result, ''.join(f'{x[1]}\t{x[2]}\n' for x in expected))
+
+            result = ''.join(client.classify(
+                self.fastq1, ResultFilter(taxids=[1239])))
+            subtree = server.taxonomy.subtree([1239])
+            selected = [x for x in expected if int(x[2]) in subtree]
+            self.assertGreater(len(selected), 0)
+            self.assertLess(len(selected), len(expected))
+            self.assertEqual(result, ''.join('\t'.join(x) for x in selected))
+
+            # an unknown taxon is rejected, and the server remains usable
+            with self.assertRaises(ValueError):
+                ''.join(client.classify(
+                    self.fastq1, ResultFilter(taxids=[10 ** 12])))
+            result = ''.join(client.classify(self.fastq1))
+        with open(self.expected_output1, 'r') as fh:
+            self.assertEqual(fh.read(), result)
+
+    def test_017_output_formats(self):
+        """The client entry point writes columnar formats."""
+        with open(self.expected_output1, 'r') as fh:
+            expected = [line.split('\t') for line in fh]
+        formats = ['binary'] + (['parquet'] if pyarrow else [])
+        with Server(
+                self.database, self.address, self.port,
+                self.k2_binary, self.threads):
+            for fmt in formats:
+                out = Path(self.out_dir) / f'out.{fmt}'
+                client_main(client_argparser().parse_args([
+                    str(self.fastq1), '--port', str(self.port),
+                    '--address', self.address, '--out', str(out),
+                    '--format', fmt, '--classified-only',
+                    '--row-group-size', '50']))
+                if fmt == 'binary':
+                    groups = list(read_binary(out))
+                    self.assertNotIn('kmer_taxid', groups[0])
+                    read_ids = sum((g['read_id'] for g in groups), [])
+                    taxids = sum((g['taxid'] for g in groups), [])
+                else:
+                    table = pyarrow.parquet.read_table(out)
+                    self.assertNotIn('kmers', table.schema.names)
+                    read_ids = table.column('read_id').to_pylist()
+                    taxids = table.column('taxid').to_pylist()
+                self.assertEqual(
+                    list(zip(read_ids, taxids)),
+                    [(x[1], int(x[2])) for x in expected if x[0] == 'C'])
+
+    def test_018_early_exit(self):
+        """Server is released when a client stops early."""
+        def failing():
+            with open(self.fastq1, 'rb') as fh:
+                yield fh.read(5000)
+            raise RuntimeError('source failed')
+
+        with ExitStack() as stack:
+            stack.enter_context(
+                Server(
+                    self.database, self.address, self.port,
+                    self.k2_binary, self.threads, msg_size=1000))
+            client = stack.enter_context(
+                Client(
+                    self.address, self.port, msg_size=1000, adaptive=False))
+            results = client.classify(self.fastq1)
+            next(results)
+            results.close()
+            self.assertTrue(client.transaction_complete)
+
+            with self.assertRaises(RuntimeError):
+                ''.join(client.classify(failing()))
+            self.assertTrue(client.transaction_complete)
+
+            result = ''.join(client.classify(self.fastq2))
+
+        with open(self.expected_output2, 'r') as fh:
+            self.assertEqual(fh.read(), result)
+
+    def test_019_waiting_filter(self):
+        """Filters of waiting clients are prepared once they begin."""
+        def client_runner(_results):
+            with Client(self.address, self.port) as client:
+                _results.append(''.join(client.classify(
+                    self.fastq1, ResultFilter(taxids=[1239]))))
+
+        with FilterCountingServer(
+                self.database, self.address, self.port,
+                self.k2_binary, self.threads) as server:
+            results = []
+            threads = [
+                Thread(target=client_runner, args=(results,))
+                for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(server.filters, 2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0], results[1])
+
     def test_020_multi_client(self):
         """Client/server integration testing.
 
@@ -176,3 +424,187 @@ class SimpleTest(unittest.TestCase):
 
                 client_str = ''.join(result)
                 self.assertEqual(corr_str, client_str)
+
+    def test_025_resume(self):
+        """Resume an interrupted transaction from a checkpoint."""
+        checkpoint = Path(self.out_dir) / 'checkpoint.json'
+        server = Server(
+            self.database, self.address, self.port,
+            self.k2_binary, self.threads, msg_size=1000)
+        server.POLL_TIMEOUT = 1
+        with server:
+            client = Client(
+                self.address, self.port, msg_size=10000, adaptive=False,
+                checkpoint=checkpoint)
+            results = client.classify(self.fastq1)
+            first = next(results)
+            # the client goes away, leaving the transaction unfinished
+            results.close()
+            self.assertTrue(checkpoint.exists())
+            self.assertFalse(client.resumed)
+
+            client = Client(self.address, self.port, checkpoint=checkpoint)
+            rest = ''.join(client.classify(self.fastq1))
+            self.assertTrue(client.resumed)
+            self.assertFalse(checkpoint.exists())
+
+        with open(self.expected_output1, 'r') as fh:
+            self.assertEqual(fh.read(), first + rest)
+
+    def test_026_reclaim(self):
+        """An abandoned transaction is reclaimed by the server."""
+        checkpoint = Path(self.out_dir) / 'checkpoint.json'
+        server = Server(
+            self.database, self.address, self.port,
+            self.k2_binary, self.threads, msg_size=1000, timeout=2)
+        server.POLL_TIMEOUT = 1
+        with server:
+            client = Client(
+                self.address, self.port, msg_size=10000, adaptive=False,
+                checkpoint=checkpoint)
+            results = client.classify(self.fastq1)
+            next(results)
+            results.close()
+
+            # another client is served once the token is reclaimed
+            with Client(self.address, self.port) as client:
+                result2 = ''.join(client.classify(self.fastq2))
+
+            # the abandoned transaction cannot be resumed, it restarts
+            client = Client(self.address, self.port, checkpoint=checkpoint)
+            result1 = ''.join(client.classify(self.fastq1))
+            self.assertFalse(client.resumed)
+
+        for result, expected in zip(
+                (result1, result2),
+                (self.expected_output1, self.expected_output2)):
+            with open(expected, 'r') as fh:
+                self.assertEqual(fh.read(), result)
+
+    def test_027_reclaim_unresponsive(self):
+        """A client that stops receiving results is reclaimed.
+
+        The client goes on sending data whilst the server cannot deliver
+        results, such that kraken2's input and output pipes fill.
+        """
+        server = Server(
+            self.database, self.address, self.port,
+            self.k2_binary, self.threads, msg_size=1000, timeout=2)
+        server.POLL_TIMEOUT = 1
+        with ExitStack() as stack:
+            stack.enter_context(server)
+            socket = zmq.Context.instance().socket(zmq.REQ)
+            stack.callback(socket.close, linger=0)
+            socket.connect(f'tcp://{self.address}:{self.port}')
+            socket.send_multipart([pack_header(Signals.GET_TOKEN), b''])
+            header, token, *_ = socket.recv_multipart()
+            self.assertEqual(
+                unpack_header(header).signal, Signals.OK_TO_BEGIN)
+            size = AdaptiveSize(100000, 100000, 100000, adaptive=False)
+            for seq, data in enumerate(batches(self.fastq1, size)):
+                socket.send_multipart([
+                    pack_header(
+                        Signals.RUN_BATCH, seq, len(data),
+                        data.count(b'\n') // 4),
+                    token, data])
+                header, = socket.recv_multipart()
+                if unpack_header(header).signal == Signals.INVALID_TOKEN:
+                    break
+            self.assertTrue(server.abandoned)
+
+            client = stack.enter_context(Client(self.address, self.port))
+            result = ''.join(client.classify(self.fastq2))
+
+        with open(self.expected_output2, 'r') as fh:
+            self.assertEqual(fh.read(), result)
+
+    def test_028_keepalive(self):
+        """Clients waiting on a slow source keep their transaction."""
+        with open(self.fastq1, 'rb') as fh:
+            data = fh.read()
+
+        def slow():
+            yield data[:100000]
+            time.sleep(4)
+            yield data[100000:]
+
+        async def aslow():
+            yield data[:100000]
+            await asyncio.sleep(4)
+            yield data[100000:]
+
+        async def run():
+            async with AsyncClient(self.address, self.port) as client:
+                client.KEEPALIVE = 0.5
+                return ''.join([x async for x in client.classify(aslow())])
+
+        with ExitStack() as stack:
+            stack.enter_context(
+                Server(
+                    self.database, self.address, self.port,
+                    self.k2_binary, self.threads, timeout=2))
+            client = stack.enter_context(Client(self.address, self.port))
+            client.KEEPALIVE = 0.5
+            results = [''.join(client.classify(slow()))]
+            results.append(asyncio.run(asyncio.wait_for(run(), timeout=60)))
+
+        with open(self.expected_output1, 'r') as fh:
+            expected = fh.read()
+        for result in results:
+            self.assertEqual(expected, result)
+
+    def test_030_async_client(self):
+        """Run several samples concurrently with the asyncio client."""
+        async def client_runner(input_):
+            async with AsyncClient(self.address, self.port) as client:
+                return ''.join([x async for x in client.classify(input_)])
+
+        async def run():
+            return await asyncio.gather(
+                client_runner(self.fastq1), client_runner(self.fastq2))
+
+        with Server(
+                self.database, self.address, self.port,
+                self.k2_binary, self.threads):
+            results = asyncio.run(run())
+
+        for result, expected in zip(
+                results, [self.expected_output1, self.expected_output2]):
+            with open(expected, 'r') as fh:
+                self.assertEqual(fh.read(), result)
+
+    def test_031_async_client_early_exit(self):
+        """Server is released when a client stops reading early."""
+        async def run():
+            async with AsyncClient(
+                    self.address, self.port,
+                    msg_size=1000, adaptive=False) as client:
+                async for _ in client.classify(self.fastq1):
+                    break
+            async with AsyncClient(self.address, self.port) as client:
+                return ''.join([x async for x in client.classify(self.fastq2)])
+
+        with Server(
+                self.database, self.address, self.port,
+                self.k2_binary, self.threads):
+            result = asyncio.run(asyncio.wait_for(run(), timeout=120))
+
+        with open(self.expected_output2, 'r') as fh:
+            self.assertEqual(fh.read(), result)
+
+    def test_032_async_client_filter(self):
+        """Results are filtered for the asyncio client."""
+        async def run():
+            async with AsyncClient(self.address, self.port) as client:
+                return ''.join([
+                    x async for x in client.classify(
+                        self.fastq2, ResultFilter(columns=['taxid']))])
+
+        with Server(
+                self.database, self.address, self.port,
+                self.k2_binary, self.threads):
+            result = asyncio.run(asyncio.wait_for(run(), timeout=120))
+
+        with open(self.expected_output2, 'r') as fh:
+            self.assertEqual(
+                ''.join(f"{line.split()[2]}\n" for line in fh), result)
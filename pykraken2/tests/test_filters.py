@@ -0,0 +1,97 @@
+"""Tests for result filters."""
+from pathlib import Path
+import unittest
+
+from pykraken2.filters import confidence, ResultFilter
+from pykraken2.taxonomy import Taxonomy
+
+
+class FiltersTest(unittest.TestCase):
+    """Test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Load the test database taxonomy."""
+        data_dir = Path(__file__).parent / 'test_data'
+        cls.taxonomy = Taxonomy(data_dir / 'db')
+        cls.lines = [
+            'C\tr1\t1239\t150\t0:4 1239:2 91061:2 2:2 A:2 |:| 1385:1\n',
+            'C\tr2\t1236\t150\t0:2 1236:8\n',
+            'U\tr3\t0\t150\t0:10\n']
+
+    def apply(self, result_filter):
+        """Apply a filter to the test lines."""
+        result_filter.bind(self.taxonomy)
+        return [
+            x for x in map(result_filter.apply, self.lines) if x is not None]
+
+    def test_000_confidence(self):
+        """Confidence is the fraction of k-mers in the clade."""
+        self.assertAlmostEqual(
+            confidence(1239, '0:4 1239:2 91061:2 2:2 A:2 |:| 1385:1',
+                       self.taxonomy), 5 / 13)
+        self.assertEqual(confidence(2, '0:4 1239:4', self.taxonomy), 0.5)
+        self.assertEqual(confidence(0, '0:4', self.taxonomy), 0)
+        # unknown taxa are outside any clade
+        self.assertEqual(
+            confidence(2, '0:4 1239:2 999999999:2', self.taxonomy), 0.25)
+        self.assertEqual(confidence(999999999, '0:4', self.taxonomy), 0)
+
+    def test_001_no_filter(self):
+        """An empty filter keeps everything."""
+        self.assertEqual(self.apply(ResultFilter()), self.lines)
+
+    def test_002_classified(self):
+        """Unclassified reads are removed."""
+        self.assertEqual(
+            self.apply(ResultFilter(classified_only=True)), self.lines[:2])
+
+    def test_003_taxids(self):
+        """Reads outside the subtrees of taxa are removed."""
+        self.assertEqual(
+            self.apply(ResultFilter(taxids=[1239])), self.lines[:1])
+        self.assertEqual(
+            self.apply(ResultFilter(taxids=[2])), self.lines[:2])
+        self.assertEqual(self.apply(ResultFilter(taxids=[1385])), [])
+
+    def test_004_min_confidence(self):
+        """Reads with low confidence are removed."""
+        self.assertEqual(
+            self.apply(ResultFilter(min_confidence=0.5)), self.lines[1:2])
+        self.assertEqual(
+            self.apply(ResultFilter(min_confidence=0.3)), self.lines[:2])
+
+    def test_005_columns(self):
+        """Columns are selected and reordered."""
+        self.assertEqual(
+            self.apply(ResultFilter(
+                classified_only=True, columns=['taxid', 'read_id'])),
+            ['1239\tr1\n', '1236\tr2\n'])
+
+    def test_006_pack(self):
+        """Filters survive serialisation."""
+        result_filter = ResultFilter(
+            classified_only=True, taxids=[2, 1], min_confidence=0.1,
+            columns=['read_id'])
+        self.assertEqual(
+            ResultFilter.unpack(result_filter.pack()), result_filter)
+
+    def test_007_invalid(self):
+        """Invalid filters raise ValueError."""
+        with self.assertRaises(ValueError):
+            ResultFilter(min_confidence=2)
+        with self.assertRaises(ValueError):
+            ResultFilter(columns=['name'])
+        with self.assertRaises(ValueError):
+            ResultFilter(columns=[])
+        with self.assertRaises(ValueError):
+            ResultFilter.unpack(b'\x01\x02')
+        with self.assertRaises(ValueError):
+            ResultFilter.unpack(ResultFilter().pack()[:-1])
+
+    def test_008_selects_reads(self):
+        """Filters that may remove reads are recognised."""
+        self.assertFalse(ResultFilter(columns=['read_id']).selects_reads)
+        self.assertTrue(ResultFilter(classified_only=True).selects_reads)
+        self.assertTrue(ResultFilter(taxids=[2]).selects_reads)
+        self.assertTrue(ResultFilter(min_confidence=0.1).selects_reads)
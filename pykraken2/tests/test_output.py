@@ -0,0 +1,146 @@
+"""Tests for writers of results."""
+from pathlib import Path
+import shutil
+import tempfile
+import unittest
+
+from pykraken2.output import (
+    AMBIGUOUS, MATE_SEPARATOR, open_writer, parse_kmers, read_binary,
+    ResultWriter, split_lines)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def _chunks(data, size):
+    """Split text into chunks, ignoring line boundaries."""
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class OutputTest(unittest.TestCase):
+    """Test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Read expected results."""
+        data_dir = Path(__file__).parent / 'test_data'
+        with open(data_dir / 'correct_output' / 'k2out1.tsv', 'r') as fh:
+            cls.data = fh.read()
+        cls.lines = [x.split('\t') for x in cls.data.splitlines()]
+        cls.columns = {
+            'read_id': [x[1] for x in cls.lines],
+            'classified': [x[0] == 'C' for x in cls.lines],
+            'taxid': [int(x[2]) for x in cls.lines],
+            'length': [int(x[3]) for x in cls.lines]}
+
+    def setUp(self):
+        """Create an output directory."""
+        self.out_dir = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        """Remove output directory."""
+        shutil.rmtree(self.out_dir)
+
+    def write(self, fmt, size=1000, **kwargs):
+        """Write the test results in chunks of `size`."""
+        path = self.out_dir / f'out.{fmt}'
+        with open_writer(path, fmt, **kwargs) as writer:
+            for chunk in _chunks(self.data, size):
+                writer.write(chunk)
+        return path
+
+    def test_000_parse_kmers(self):
+        """Ambiguous k-mers and mate separators are given taxids."""
+        self.assertEqual(
+            parse_kmers('0:10 562:5 A:2 |:| 561:3'),
+            ([0, 562, AMBIGUOUS, MATE_SEPARATOR, 561], [10, 5, 2, 0, 3]))
+
+    def test_001_text(self):
+        """Text is written as is, and may be appended."""
+        path = self.write('text')
+        with open_writer(path, 'text', append=True) as writer:
+            writer.write('more\n')
+        with open(path, 'r') as fh:
+            self.assertEqual(fh.read(), self.data + 'more\n')
+        # the base of columnar writers is abstract
+        with self.assertRaises(TypeError):
+            ResultWriter(self.out_dir / 'x')
+
+    def test_002_binary(self):
+        """Binary output reads back in row groups."""
+        for compression in (None, 'gzip'):
+            path = self.write(
+                'binary', row_group_size=100, kmers=True,
+                compression=compression)
+            groups = list(read_binary(path))
+            self.assertEqual(len(groups), -(-len(self.lines) // 100))
+            for key, value in self.columns.items():
+                self.assertEqual(sum((g[key] for g in groups), []), value)
+            group = groups[0]
+            offsets = group['kmer_offsets']
+            self.assertEqual(len(offsets), len(group['read_id']) + 1)
+            self.assertEqual(
+                (group['kmer_taxid'][offsets[1]:offsets[2]],
+                 group['kmer_count'][offsets[1]:offsets[2]]),
+                parse_kmers(self.lines[1][4]))
+
+    def test_003_binary_invalid(self):
+        """Other files are not read as binary output."""
+        path = self.write('text')
+        with self.assertRaises(ValueError):
+            list(read_binary(path))
+        with self.assertRaises(ValueError):
+            open_writer(self.out_dir / 'x', 'binary', compression='lzma')
+        with self.assertRaises(ValueError):
+            open_writer(self.out_dir / 'x', 'csv')
+
+    def test_004_split_lines(self):
+        """Lines split across chunks are joined."""
+        self.assertEqual(
+            list(split_lines(['a\nb', 'c\n', '', 'd\ne'])),
+            [['a'], ['bc'], [], ['d'], ['e']])
+        self.assertEqual(
+            sum(split_lines(_chunks(self.data, 1000)), []),
+            self.data.splitlines())
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed.")
+    def test_010_parquet(self):
+        """Parquet output has typed columns and row groups."""
+        path = self.write(
+            'parquet', row_group_size=100, compression='snappy',
+            dictionary=['taxid'])
+        parquet = pyarrow.parquet.ParquetFile(path)
+        self.assertEqual(
+            parquet.metadata.num_row_groups, -(-len(self.lines) // 100))
+        table = parquet.read()
+        self.assertEqual(
+            table.schema.names, ['read_id', 'classified', 'taxid', 'length'])
+        self.assertEqual(table.schema.field('taxid').type, pyarrow.uint64())
+        self.assertEqual(table.to_pydict(), self.columns)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed.")
+    def test_011_parquet_kmers(self):
+        """k-mer hits are written as lists of structs."""
+        path = self.write('parquet', kmers=True, compression=None)
+        kmers = pyarrow.parquet.read_table(path).column('kmers').to_pylist()
+        self.assertEqual(len(kmers), len(self.lines))
+        for hits, line in zip(kmers, self.lines):
+            self.assertEqual(
+                ([x['taxid'] for x in hits], [x['count'] for x in hits]),
+                parse_kmers(line[4]))
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed.")
+    def test_012_arrow(self):
+        """Arrow IPC output is written in record batches."""
+        path = self.write(
+            'arrow', row_group_size=100, kmers=True, compression='zstd')
+        with pyarrow.ipc.open_file(path) as reader:
+            self.assertEqual(
+                reader.num_record_batches, -(-len(self.lines) // 100))
+            table = reader.read_all()
+        columns = table.to_pydict()
+        del columns['kmers']
+        self.assertEqual(columns, self.columns)
@@ -0,0 +1,44 @@
+"""Tests for the wire protocol."""
+import unittest
+
+from pykraken2 import (
+    HEADER, Header, pack_header, PROTOCOL_VERSION, Signals, unpack_header)
+
+
+class HeaderTest(unittest.TestCase):
+    """Test class."""
+
+    def test_000_round_trip(self):
+        """Headers unpack to the values packed."""
+        for signal in Signals:
+            for seq in (-1, 0, 1, 2 ** 40):
+                frame = pack_header(signal, seq, 12345, 67, flags=3)
+                self.assertEqual(len(frame), HEADER.size)
+                self.assertEqual(
+                    unpack_header(frame), Header(signal, 3, seq, 12345, 67))
+
+    def test_001_defaults(self):
+        """Sequence number, length, count and flags default to zero."""
+        self.assertEqual(
+            unpack_header(pack_header(Signals.GET_TOKEN)),
+            Header(Signals.GET_TOKEN, 0, 0, 0, 0))
+
+    def test_002_invalid(self):
+        """Frames that are not valid headers raise ValueError."""
+        frame = pack_header(Signals.RUN_BATCH, 1, 10)
+        with self.assertRaises(ValueError):
+            unpack_header(frame[:-1])
+        with self.assertRaises(ValueError):
+            unpack_header(b'')
+        with self.assertRaises(ValueError):
+            unpack_header(
+                bytes([PROTOCOL_VERSION + 1]) + frame[1:])
+        with self.assertRaises(ValueError):
+            unpack_header(frame[:1] + bytes([255]) + frame[2:])
+
+    def test_003_memoryview(self):
+        """Headers unpack from buffers, such as those of ZMQ frames."""
+        frame = pack_header(Signals.TRANSACTION_COMPLETE, 7, 100)
+        self.assertEqual(
+            unpack_header(memoryview(frame)),
+            Header(Signals.TRANSACTION_COMPLETE, 0, 7, 100, 0))
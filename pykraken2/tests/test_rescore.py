@@ -0,0 +1,138 @@
+"""Tests for confidence re-scoring."""
+import math
+from pathlib import Path
+import unittest
+
+from pykraken2.taxonomy import Taxonomy
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+else:
+    from pykraken2.rescore import kmer_arrays, Rescorer
+
+
+def _resolve_tree(line, threshold, taxonomy):
+    """Classify a read as kraken2's ResolveTree, for comparison."""
+    hits, total = dict(), 0
+    for hit in line.split('\t')[4].split():
+        taxid, count = hit.split(':')
+        if taxid == '|':
+            continue
+        total += int(count)
+        if taxid not in ('0', 'A'):
+            hits[int(taxid)] = hits.get(int(taxid), 0) + int(count)
+    required = math.ceil(threshold * total)
+    call, best = 0, 0
+    for taxid in hits:
+        score = sum(
+            count for other, count in hits.items()
+            if taxonomy.is_ancestor(other, taxid))
+        if score > best:
+            call, best = taxid, score
+        elif score == best:
+            call = taxonomy.lca(call, taxid)
+    score = hits.get(call, 0)
+    while call and score < required:
+        score = sum(
+            count for other, count in hits.items()
+            if taxonomy.is_ancestor(call, other))
+        if score >= required:
+            return call
+        call = taxonomy.parent(call)
+    return call
+
+
+@unittest.skipIf(np is None, "numpy is not installed.")
+class RescoreTest(unittest.TestCase):
+    """Test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Load taxonomy and results."""
+        data_dir = Path(__file__).parent / 'test_data'
+        cls.taxonomy = Taxonomy(data_dir / 'db')
+        cls.rescorer = Rescorer(cls.taxonomy)
+        cls.lines = []
+        for name in ('k2out1.tsv', 'k2out2.tsv'):
+            with open(data_dir / 'correct_output' / name, 'r') as fh:
+                cls.lines.extend(fh.read().splitlines())
+
+    def test_000_kmer_arrays(self):
+        """Parse k-mer columns into flat arrays."""
+        offsets, taxids, counts = kmer_arrays([
+            'C\tr1\t2\t10\t0:1 2:3 A:2 |:| 1239:4', 'U\tr2\t0\t10\t0:5'])
+        self.assertEqual(offsets.tolist(), [0, 5, 6])
+        self.assertEqual(taxids.tolist(), [0, 2, -1, -2, 1239, 0])
+        self.assertEqual(counts.tolist(), [1, 3, 2, 0, 4, 5])
+        with self.assertRaises(ValueError):
+            kmer_arrays(['C\tr1\t2\t10\t0:1 2:x'])
+
+    def test_001_kraken2_calls(self):
+        """Re-scoring at zero confidence reproduces kraken2."""
+        expected = [int(line.split('\t')[2]) for line in self.lines]
+        read_ids, calls = self.rescorer.rescore_lines(self.lines, 0)
+        self.assertEqual(calls.tolist(), expected)
+        self.assertEqual(
+            read_ids, [line.split('\t')[1] for line in self.lines])
+
+    def test_002_thresholds(self):
+        """Re-scoring matches ResolveTree at many thresholds."""
+        thresholds = [0, 0.01, 0.05, 0.1, 0.2, 0.5, 1]
+        calls = self.rescorer.rescore(*kmer_arrays(self.lines), thresholds)
+        self.assertEqual(calls.shape, (len(thresholds), len(self.lines)))
+        for threshold, row in zip(thresholds, calls):
+            expected = [
+                _resolve_tree(line, threshold, self.taxonomy)
+                for line in self.lines]
+            self.assertEqual(row.tolist(), expected)
+        # fewer reads are classified, at higher ranks, as confidence rises
+        classified = (calls > 0).sum(axis=1)
+        self.assertTrue((np.diff(classified) <= 0).all())
+        self.assertGreater(classified[0], classified[4])
+
+    def test_003_cases(self):
+        """Ties, ambiguous k-mers, paired reads and unclassified reads."""
+        lines = [
+            # 1236 and 1239 tie, their LCA is Bacteria
+            'C\tr1\t2\t10\t1236:3 1239:3',
+            # ambiguous k-mers count towards the total
+            'C\tr2\t1239\t10\t1239:4 A:6',
+            # mate separator does not
+            'C\tr3\t1239\t10\t1239:2 |:| 0:1 1239:2',
+            'U\tr4\t0\t10\t0:5 A:5',
+            'U\tr5\t0\t0\t']
+        calls = self.rescorer.rescore(*kmer_arrays(lines), [0, 0.5, 0.8])
+        self.assertEqual(calls.tolist(), [
+            [2, 1239, 1239, 0, 0],
+            [2, 0, 1239, 0, 0],
+            [2, 0, 1239, 0, 0]])
+        calls = self.rescorer.rescore(*kmer_arrays(lines[:1]), 1)
+        self.assertEqual(calls.tolist(), [2])
+
+    def test_004_chunks(self):
+        """Streamed results split across chunks are re-scored in batches."""
+        text = ''.join(f'{line}\n' for line in self.lines)
+        chunks = [text[i:i + 5000] for i in range(0, len(text), 5000)]
+        expected_ids, expected = self.rescorer.rescore_lines(
+            self.lines, [0, 0.1])
+        for batch_size in (1, 300, 100000):
+            read_ids, calls = [], []
+            for ids, result in self.rescorer.rescore_chunks(
+                    chunks, [0, 0.1], batch_size=batch_size):
+                self.assertLessEqual(len(ids), batch_size)
+                read_ids.extend(ids)
+                calls.append(result)
+            self.assertEqual(
+                len(calls), -(-len(self.lines) // batch_size))
+            self.assertEqual(read_ids, expected_ids)
+            self.assertEqual(np.hstack(calls).tolist(), expected.tolist())
+
+    def test_005_invalid(self):
+        """Invalid thresholds and unknown taxa raise ValueError."""
+        arrays = kmer_arrays(['C\tr1\t2\t10\t2:1'])
+        with self.assertRaises(ValueError):
+            self.rescorer.rescore(*arrays, 1.5)
+        with self.assertRaises(ValueError):
+            self.rescorer.rescore(*kmer_arrays(['C\tr1\t2\t10\t3:1']), 0)
@@ -0,0 +1,179 @@
+"""Tests for client input sources."""
+import asyncio
+import io
+from pathlib import Path
+import unittest
+
+from pykraken2 import AdaptiveSize
+from pykraken2.sources import (
+    abatches, batches, format_record, skip_records)
+from pykraken2.tests.util import read_records
+
+
+async def _collect(source, size):
+    return [x async for x in abatches(source, size)]
+
+
+class SourcesTest(unittest.TestCase):
+    """Test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set paths and other variables for tests."""
+        cls.fastq = Path(__file__).parent / 'test_data' / 'reads1.fq'
+        with open(cls.fastq, 'rb') as fh:
+            cls.data = fh.read()
+
+    def setUp(self):
+        """Create a fixed message size."""
+        self.size = AdaptiveSize(10000, 1, 100000, adaptive=False)
+
+    def assertBatches(self, batches, expected):
+        """Check batches reconstitute the input and hold whole records."""
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(b''.join(batches), expected)
+        for batch in batches:
+            self.assertTrue(batch.startswith(b'@'))
+            self.assertEqual(batch.count(b'\n') % 4, 0)
+
+    def test_000_format_record(self):
+        """Format records with and without quality."""
+        self.assertEqual(
+            format_record(('r1', 'ACGT', '!!!!')), b'@r1\nACGT\n+\n!!!!\n')
+        self.assertEqual(
+            format_record((b'r1', b'AC')), b'@r1\nAC\n+\nII\n')
+        self.assertEqual(
+            format_record(('r1', 'AC', None)), b'@r1\nAC\n+\nII\n')
+
+    def test_001_path(self):
+        """Read from a path."""
+        self.assertBatches(list(batches(self.fastq, self.size)), self.data)
+
+    def test_002_file(self):
+        """Read from binary and text file-like objects."""
+        self.assertBatches(
+            list(batches(io.BytesIO(self.data), self.size)), self.data)
+        self.assertBatches(
+            list(batches(io.StringIO(self.data.decode()), self.size)),
+            self.data)
+
+    def test_003_buffer(self):
+        """Read from bytes-like buffers."""
+        for buffer in (
+                self.data, bytearray(self.data), memoryview(self.data)):
+            self.assertBatches(list(batches(buffer, self.size)), self.data)
+
+    def test_004_records(self):
+        """Read from an iterator of records."""
+        records = iter(read_records(self.fastq))
+        self.assertBatches(list(batches(records, self.size)), self.data)
+
+    def test_005_lazy(self):
+        """Sources are consumed only as messages are requested."""
+        consumed = []
+
+        def records():
+            for record in read_records(self.fastq):
+                consumed.append(record)
+                yield record
+
+        gen = batches(records(), self.size)
+        first = next(gen)
+        self.assertLess(len(consumed), len(read_records(self.fastq)))
+        self.assertLess(len(first), self.size.value)
+
+    def test_006_unsupported(self):
+        """Unsupported sources raise TypeError."""
+        with self.assertRaises(TypeError):
+            list(batches(1, self.size))
+
+    def test_007_skip_records(self):
+        """Leading records are skipped regardless of message size."""
+        records = read_records(self.fastq)
+        for skip in (0, 1, 7, len(records)):
+            expected = b''.join(format_record(r) for r in records[skip:])
+            for size in (100, 5000, 100000):
+                self.size.value = size
+                messages = skip_records(batches(records, self.size), skip)
+                self.assertEqual(b''.join(messages), expected)
+
+
+class AsyncSourcesTest(unittest.TestCase):
+    """Test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set paths and other variables for tests."""
+        cls.fastq = Path(__file__).parent / 'test_data' / 'reads1.fq'
+        with open(cls.fastq, 'rb') as fh:
+            cls.data = fh.read()
+        cls.records = [
+            f'@read{i}\nACGT\n+\nIIII\n' for i in range(10)]
+
+    def setUp(self):
+        """Create a fixed message size."""
+        self.size = AdaptiveSize(1000, 1, 10000, adaptive=False)
+
+    def assertBatches(self, batches, expected):
+        """Check batches reconstitute the input and hold whole records."""
+        self.assertEqual(b''.join(batches), expected)
+        for batch in batches:
+            self.assertTrue(batch.startswith(b'@'))
+            self.assertEqual(batch.count(b'\n') % 4, 0)
+
+    def test_000_path(self):
+        """Read from a path."""
+        batches = asyncio.run(_collect(self.fastq, self.size))
+        self.assertGreater(len(batches), 1)
+        self.assertBatches(batches, self.data)
+        batches = asyncio.run(_collect(str(self.fastq), self.size))
+        self.assertBatches(batches, self.data)
+
+    def test_001_async_iterable(self):
+        """Read from an async iterable of str and bytes records."""
+        self.size = AdaptiveSize(50, 1, 10000, adaptive=False)
+
+        async def records():
+            for i, record in enumerate(self.records):
+                yield record if i % 2 else record.encode()
+
+        batches = asyncio.run(_collect(records(), self.size))
+        self.assertGreater(len(batches), 1)
+        self.assertBatches(batches, ''.join(self.records).encode())
+
+        async def tuples():
+            for record in read_records(self.fastq):
+                yield record
+
+        batches = asyncio.run(_collect(tuples(), self.size))
+        self.assertBatches(batches, self.data)
+
+    def test_002_coroutine_read(self):
+        """Read from an object with a coroutine read method."""
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(self.data)
+            reader.feed_eof()
+            return await _collect(reader, self.size)
+
+        batches = asyncio.run(run())
+        self.assertBatches(batches, self.data)
+
+    def test_003_blocking_read(self):
+        """Read from a blocking file-like object."""
+        batches = asyncio.run(_collect(io.BytesIO(self.data), self.size))
+        self.assertBatches(batches, self.data)
+        batches = asyncio.run(
+            _collect(io.StringIO(self.data.decode()), self.size))
+        self.assertBatches(batches, self.data)
+
+    def test_004_final_newline(self):
+        """A missing final newline is added."""
+        data = self.data.rstrip(b'\n')
+        batches = asyncio.run(_collect(io.BytesIO(data), self.size))
+        self.assertBatches(batches, self.data)
+
+    def test_005_unsupported(self):
+        """Unsupported sources raise TypeError."""
+        with self.assertRaises(TypeError):
+            asyncio.run(_collect(self.records, self.size))
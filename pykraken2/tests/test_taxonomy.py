@@ -0,0 +1,69 @@
+"""Tests for the kraken2 database taxonomy."""
+from pathlib import Path
+import tempfile
+import unittest
+
+from pykraken2.taxonomy import Taxonomy
+
+
+class TaxonomyTest(unittest.TestCase):
+    """Test class."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Load the test database taxonomy."""
+        cls.database = Path(__file__).parent / 'test_data' / 'db'
+        cls.taxonomy = Taxonomy(cls.database)
+
+    def test_000_load(self):
+        """Load from a database directory or taxo.k2d file."""
+        self.assertEqual(len(self.taxonomy), 35065)
+        taxonomy = Taxonomy(self.database / 'taxo.k2d')
+        self.assertEqual(taxonomy.external_ids, self.taxonomy.external_ids)
+
+    def test_001_invalid(self):
+        """Files other than a kraken2 taxonomy raise ValueError."""
+        with self.assertRaises(ValueError):
+            Taxonomy(self.database / 'opts.k2d')
+        with tempfile.NamedTemporaryFile() as fh:
+            with self.assertRaises(ValueError):
+                Taxonomy(fh.name)
+
+    def test_002_names(self):
+        """Names and ranks of taxa."""
+        self.assertEqual(self.taxonomy.name(1), 'root')
+        self.assertEqual(self.taxonomy.name(2), 'Bacteria')
+        self.assertEqual(self.taxonomy.rank(2), 'superkingdom')
+        self.assertEqual(self.taxonomy.rank(1239), 'phylum')
+        with self.assertRaises(KeyError):
+            self.taxonomy.name(10 ** 12)
+
+    def test_003_lineage(self):
+        """Lineages end at the root."""
+        self.assertEqual(
+            self.taxonomy.lineage(576944),
+            [576944, 150247, 186817, 1385, 91061, 1239, 1783272, 2, 131567,
+             1])
+        self.assertEqual(self.taxonomy.parent(576944), 150247)
+        self.assertEqual(self.taxonomy.parent(1), 0)
+
+    def test_004_ancestors(self):
+        """Ancestry and lowest common ancestors."""
+        self.assertTrue(self.taxonomy.is_ancestor(1239, 576944))
+        self.assertTrue(self.taxonomy.is_ancestor(1239, 1239))
+        self.assertFalse(self.taxonomy.is_ancestor(576944, 1239))
+        self.assertFalse(self.taxonomy.is_ancestor(1224, 576944))
+        self.assertEqual(self.taxonomy.lca(576944, 1279), 1385)
+        self.assertEqual(self.taxonomy.lca(1239, 1236), 2)
+        self.assertEqual(self.taxonomy.lca(0, 1236), 1236)
+
+    def test_005_subtree(self):
+        """Subtrees contain taxa and their descendants."""
+        subtree = self.taxonomy.subtree([1385])
+        self.assertIn(1385, subtree)
+        self.assertIn(576944, subtree)
+        self.assertNotIn(1239, subtree)
+        for taxid in subtree:
+            self.assertTrue(self.taxonomy.is_ancestor(1385, taxid))
+        both = self.taxonomy.subtree([1385, 1236])
+        self.assertEqual(both, subtree | self.taxonomy.subtree([1236]))
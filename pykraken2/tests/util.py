@@ -0,0 +1,13 @@
+"""Helpers shared by tests."""
+
+
+def read_records(fastq):
+    """Parse a FASTQ file into (id, sequence, quality) tuples.
+
+    The id is the whole header line, less the leading '@'.
+    """
+    with open(fastq, 'r') as fh:
+        lines = fh.read().splitlines()
+    return [
+        (lines[i][1:], lines[i + 1], lines[i + 3])
+        for i in range(0, len(lines), 4)]
@@ -43,7 +43,11 @@ with open(os.path.join(dir_path, 'requirements.txt')) as fh:
         pkg_resources.parse_requirements(fh)]
 
 data_files = []
-extra_requires = {}
+extra_requires = {
+    'bam': ['pysam>=0.21'],
+    'arrow': ['pyarrow>=10'],
+    'rescore': ['numpy>=1.20'],
+}
 extensions = []
 
 
@@ -62,7 +66,9 @@ setup(
     tests_require=[].extend(install_requires),
     extras_require=extra_requires,
     # don't include any testing subpackages in dist
-    packages=find_packages(exclude=['*.test', '*.test.*', 'test.*', 'test']),
+    packages=find_packages(exclude=[
+        '*.test', '*.test.*', 'test.*', 'test',
+        '*.tests', '*.tests.*', 'tests.*', 'tests']),
     package_data={__pkg_name__:[os.path.join('data', '*')]},
     zip_safe=False,
     data_files=data_files,